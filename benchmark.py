@@ -0,0 +1,571 @@
+'''
+Benchmark harness driving WebhookManager with synthetic Telegram updates.
+
+OpenAI is replaced by a fake completion endpoint with a configurable latency
+and token usage, and the Telegram API by a stub which records when every reply
+is sent. The database is a temporary file behind SQLiteStorage, an in-memory
+stand-in behind the real DatabaseManager with --database memory, or a local
+Postgres with --database postgres. Every SQL statement is counted.
+
+Usage:
+    python benchmark.py                    compare every scenario with the baseline
+    python benchmark.py --save-baseline    store the results as the new baseline
+    python benchmark.py hot_group          run selected scenarios
+    python benchmark.py --storage-format snapshot --baseline snapshot_baseline.json
+
+Baselines are only comparable when they are recorded on the same machine
+with the same --database and --storage-format. The baseline file records both
+and a run against a different backend is not compared with it.
+'''
+import argparse
+import json
+import math
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+from types import SimpleNamespace
+from unittest.mock import patch
+
+import psycopg2
+import psycopg2.extensions
+import psycopg2.extras
+
+import bot
+
+BASELINE_FILE = 'benchmark_baseline.json'
+# Chat ids far from real ones, so a benchmark against Postgres can clean up after itself
+CHAT_ID_OFFSET = 9000000000
+
+SCENARIOS = {
+    # Many chats sending a single message each after their conversations were evicted
+    'idle_chats': {'chats': 300, 'messages_per_chat': 1, 'mentions': 1, 'group': False, 'cold': True, 'rate': 200},
+    # One busy group whose updates are processed one after another
+    'hot_group': {'chats': 1, 'messages_per_chat': 200, 'mentions': 1, 'group': True, 'cold': False, 'rate': 20},
+    # Group messages mentioning several characters at once
+    'multi_mention': {'chats': 20, 'messages_per_chat': 10, 'mentions': 3, 'group': True, 'cold': False, 'rate': 50},
+    # The same with the characters replying concurrently
+    'multi_mention_concurrent': {'chats': 20, 'messages_per_chat': 10, 'mentions': 3, 'group': True, 'cold': False,
+                                 'rate': 50, 'environment': {'CONCURRENT_REPLIES': '1'}},
+}
+
+
+class FakeOpenAI:
+    '''
+    Stands in for openai.ChatCompletion.create.
+    '''
+    def __init__(self, latency, completion_tokens):
+        self.latency = latency
+        self.completion_tokens = completion_tokens
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def create(self, messages, stream=False, **kwargs):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.latency)
+        content = 'word ' * self.completion_tokens
+        prompt_tokens = sum(bot.estimate_message_tokens(message) for message in messages)
+        if stream:
+            return iter([{'choices': [{'delta': {'content': content}}]},
+                         {'choices': [], 'usage': {'total_tokens': prompt_tokens + self.completion_tokens}}])
+        return {'choices': [{'message': {'content': content}}],
+                'usage': {'total_tokens': prompt_tokens + self.completion_tokens}}
+
+
+class StubTelegramApi:
+    '''
+    Replaces the network methods of a TeleBot and records when the replies to every message were sent.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reply_times = {}
+        self.sources = {}
+        self.next_message_id = 1
+        self.replies = 0
+
+    def install(self, telegram_api):
+        telegram_api.reply_to = self.reply_to
+        telegram_api.edit_message_text = self.edit_message_text
+        telegram_api.set_webhook = lambda *args, **kwargs: True
+        telegram_api.remove_webhook = lambda *args, **kwargs: True
+
+    def reply_to(self, message, text):
+        source = (message.chat.id, message.message_id)
+        with self.lock:
+            self.next_message_id += 1
+            reply = SimpleNamespace(chat=SimpleNamespace(id=message.chat.id), message_id=-self.next_message_id)
+            self.sources[reply.message_id] = source
+            self.record(source)
+        return reply
+
+    def edit_message_text(self, text, chat_id, message_id):
+        with self.lock:
+            self.record(self.sources[message_id])
+        return True
+
+    def record(self, source):
+        self.replies += 1
+        self.reply_times[source] = time.perf_counter()
+
+
+class InMemoryDatabase:
+    '''
+    Minimal stand-in for the tables used by DatabaseManager. It understands
+    the statements the bot sends and counts every one of them.
+    '''
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.conversations = {}
+        self.statements = 0
+
+    def connect(self, **kwargs):
+        return InMemoryConnection(self)
+
+    def count(self, statements=1):
+        with self.lock:
+            self.statements += statements
+
+
+class InMemoryConnection:
+    def __init__(self, database):
+        self.database = database
+        self.closed = 0
+        self.autocommit = False
+
+    def cursor(self):
+        return InMemoryCursor(self.database)
+
+    def commit(self):
+        pass
+
+    def rollback(self):
+        pass
+
+    def close(self):
+        self.closed = 1
+
+
+class InMemoryCursor:
+    def __init__(self, database):
+        self.database = database
+        self.result = None
+        self.rowcount = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+    def execute(self, sql, params=()):
+        self.database.count()
+        self.rowcount = 1
+        conversations = self.database.conversations
+        with self.database.lock:
+            if sql.startswith('INSERT INTO conversations'):
+                conversation_id, tokens, message_seq, summary, summarized_seq = params
+                stored = conversations.setdefault(conversation_id, {'characters': [], 'messages': []})
+                stored.update(tokens=tokens, message_seq=message_seq, summary=summary, summarized_seq=summarized_seq)
+            elif sql.startswith('DELETE FROM messages'):
+                conversations[params[0]]['messages'] = []
+            elif sql.startswith('SELECT c.tokens'):
+                self.result = self.load(conversations.get(params[3]), params[1])
+
+    def load(self, stored, history_length):
+        if stored is None:
+            return None
+        messages = []
+        size = 0
+        for message in reversed(stored['messages']):
+            size += len(message['content'].encode('utf-8'))
+            if history_length is not None and size > history_length:
+                break
+            messages.append(message)
+        messages.reverse()
+        return (stored['tokens'], stored['message_seq'], stored['summary'], stored['summarized_seq'],
+                list(stored['characters']), messages)
+
+    def execute_values(self, sql, rows):
+        self.database.count()
+        with self.database.lock:
+            if 'INTO messages' in sql:
+                for conversation_id, role, content in rows:
+                    self.database.conversations[conversation_id]['messages'].append(
+                        {'role': role, 'content': content})
+            elif 'INTO characters' in sql:
+                for name, conversation_id in rows:
+                    characters = self.database.conversations[conversation_id]['characters']
+                    if name not in characters:
+                        characters.append(name)
+
+    def fetchone(self):
+        return self.result
+
+    def fetchall(self):
+        return []
+
+
+original_execute_values = psycopg2.extras.execute_values
+
+
+def execute_values(cursor, sql, rows, page_size=100):
+    if isinstance(cursor, InMemoryCursor):
+        cursor.execute_values(sql, rows)
+    else:
+        original_execute_values(cursor, sql, rows, page_size=page_size)
+
+
+class CountingCursor(psycopg2.extensions.cursor):
+    '''
+    Cursor counting the statements sent to a real Postgres.
+    '''
+    statements = 0
+    lock = threading.Lock()
+
+    def execute(self, sql, params=None):
+        with CountingCursor.lock:
+            CountingCursor.statements += 1
+        return super().execute(sql, params)
+
+
+class PostgresDatabase:
+    def __init__(self):
+        self.connect_function = psycopg2.connect
+
+    def connect(self, **kwargs):
+        return self.connect_function(cursor_factory=CountingCursor, **kwargs)
+
+    @property
+    def statements(self):
+        return CountingCursor.statements
+
+    def clean_up(self, chat_ids):
+        connection = self.connect_function(
+            dbname=os.environ.get('DATABASE_NAME'), user=os.environ.get('DATABaSE_USER_NAME'),
+            password=os.environ.get('DATABSAE_PASSWORD'), host=os.environ.get('DATABASE_HOST'),
+            port=os.environ.get('DATABASE_PORT'))
+        with connection, connection.cursor() as cursor:
+            for table, column in (('messages', 'conversation_id'), ('characters', 'conversation_id'),
+                                  ('conversations', 'id'), ('conversation_snapshots', 'id')):
+                cursor.execute('DELETE FROM {} WHERE {} = ANY(%s);'.format(table, column), (list(chat_ids),))
+        connection.close()
+
+
+class SQLiteDatabase:
+    '''
+    Temporary database file of the SQLiteStorage, counting the statements sent to it.
+    '''
+    # Transaction control is not counted, like the commits of the Postgres connections
+    UNCOUNTED = ('BEGIN IMMEDIATE;', 'BEGIN;', 'COMMIT;', 'ROLLBACK;')
+
+    def __init__(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'benchmark.sqlite3')
+        self.connect_function = sqlite3.connect
+        self.lock = threading.Lock()
+        self.statements = 0
+
+    def connect(self, *args, **kwargs):
+        connection = self.connect_function(*args, **kwargs)
+        connection.set_trace_callback(self.count)
+        return connection
+
+    def count(self, statement):
+        if statement not in self.UNCOUNTED:
+            with self.lock:
+                self.statements += 1
+
+    def clean_up(self, chat_ids):
+        connection = self.connect_function(self.path)
+        with connection:
+            for table, column in (('messages', 'conversation_id'), ('characters', 'conversation_id'),
+                                  ('conversations', 'id'), ('conversation_snapshots', 'id')):
+                connection.executemany('DELETE FROM {} WHERE {} = ?;'.format(table, column),
+                                       [(chat_id,) for chat_id in chat_ids])
+        connection.close()
+
+    def close(self):
+        self.directory.cleanup()
+
+
+def make_update(update_id, chat_id, message_id, text, is_group):
+    return {
+        'update_id': update_id,
+        'message': {
+            'message_id': message_id,
+            'date': int(time.time()),
+            'chat': {'id': chat_id, 'type': 'group' if is_group else 'private'},
+            'from': {'id': 1000 + message_id % 50, 'is_bot': False, 'first_name': 'User{}'.format(message_id % 50)},
+            'text': text,
+        }
+    }
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, math.ceil(fraction * len(values)) - 1))]
+
+
+class Harness:
+    '''
+    Runs one scenario against a fresh TelegramBot and WebhookManager.
+    '''
+    def __init__(self, scenario, database, fake_openai, rate=None):
+        self.scenario = scenario
+        self.database = database
+        self.fake_openai = fake_openai
+        self.rate = scenario['rate'] if rate is None else rate
+        self.update_id = 0
+        self.message_id = 0
+        self.processed_times = {}
+        self.lock = threading.Lock()
+        self.bot = None
+
+    def start(self):
+        self.telegram_stub = StubTelegramApi()
+        self.bot = bot.TelegramBot()
+        self.telegram_stub.install(self.bot.telegram_api)
+        self.webhook_manager = bot.WebhookManager(self.bot, 'https://example.com')
+        process_update = self.webhook_manager._process_update
+
+        def record_processed(update):
+            process_update(update)
+            with self.lock:
+                self.processed_times[(update.message.chat.id, update.message.message_id)] = time.perf_counter()
+        self.webhook_manager.dispatcher.handler = record_processed
+        self.webhook_manager.handle_webhook()
+        self.client = self.webhook_manager.app.test_client()
+        self.bot.start()
+        self.webhook_manager.dispatcher.start()
+
+    def wait_until_idle(self):
+        # Stopping drains the dispatcher and the sender, both can be started again
+        self.webhook_manager.dispatcher.stop()
+        self.bot.sender.stop()
+        self.webhook_manager.dispatcher.start()
+        self.bot.sender.start()
+
+    def post(self, chat_id, text):
+        self.update_id += 1
+        self.message_id += 1
+        update = make_update(self.update_id, chat_id, self.message_id, text, self.scenario['group'])
+        self.client.post('/', json=update)
+        return (chat_id, self.message_id)
+
+    def get_chat_ids(self):
+        sign = -1 if self.scenario['group'] else 1
+        return [sign * (CHAT_ID_OFFSET + i) for i in range(self.scenario['chats'])]
+
+    def set_up_chats(self, names):
+        for chat_id in self.get_chat_ids():
+            self.post(chat_id, '/start')
+            for name in names:
+                self.post(chat_id, '/init {}'.format(name))
+        self.wait_until_idle()
+        if self.scenario['cold']:
+            self.bot.conversations.flush()
+            self.bot.persistence_queue.flush()
+
+    def run(self):
+        names = list(self.bot.character_registry.characters)[:max(self.scenario['mentions'], 1)]
+        self.set_up_chats(names)
+        statements_before = self.database.statements
+        openai_calls_before = self.fake_openai.calls
+        self.telegram_stub.reply_times.clear()
+        self.processed_times.clear()
+
+        sent = {}
+        interval = 1 / self.rate if self.rate else 0
+        start = time.perf_counter()
+        for index in range(self.scenario['messages_per_chat']):
+            for chat_id in self.get_chat_ids():
+                next_time = start + len(sent) * interval
+                delay = next_time - time.perf_counter()
+                if delay > 0:
+                    time.sleep(delay)
+                text = 'Hello {} number {}'.format(' and '.join(names), index)
+                sent_at = time.perf_counter()
+                sent[self.post(chat_id, text)] = sent_at
+        self.wait_until_idle()
+        # The write-behind queue is drained, so its statements are counted too
+        self.webhook_manager.dispatcher.stop()
+        self.bot.stop()
+
+        latencies = []
+        end = start
+        for source, sent_at in sent.items():
+            done_at = max(self.processed_times.get(source, sent_at), self.telegram_stub.reply_times.get(source, sent_at))
+            latencies.append(done_at - sent_at)
+            end = max(end, done_at)
+        updates = len(sent)
+        duration = end - start
+        return {
+            'updates': updates,
+            'updates_per_second': round(updates / duration, 2) if duration else 0,
+            'p50_ms': round(percentile(latencies, 0.5) * 1000, 2),
+            'p95_ms': round(percentile(latencies, 0.95) * 1000, 2),
+            'p99_ms': round(percentile(latencies, 0.99) * 1000, 2),
+            'db_statements_per_update': round((self.database.statements - statements_before) / updates, 3),
+            'openai_calls': self.fake_openai.calls - openai_calls_before,
+        }
+
+
+def get_environment(workers):
+    # Limits of the real services would dominate the results, so they are lifted
+    return {
+        'UPDATE_WORKERS': str(workers),
+        'UPDATE_QUEUE_SIZE': '100000',
+        'UPDATE_DEDUP_DATABASE': '0',
+        'TELEGRAM_MESSAGES_PER_SECOND': '100000',
+        'TELEGRAM_GROUP_MESSAGES_PER_MINUTE': '1000000',
+        'OPENAI_REQUESTS_PER_MINUTE': '1000000',
+        'OPENAI_TOKENS_PER_MINUTE': '1000000000',
+        'OPENAI_QUEUE_SIZE': '100000',
+        'PERSISTENCE_FLUSH_INTERVAL': '0.5',
+    }
+
+
+def create_database(database_kind):
+    if database_kind == 'sqlite':
+        return SQLiteDatabase()
+    if database_kind == 'memory':
+        return InMemoryDatabase()
+    return PostgresDatabase()
+
+
+def run_scenarios(names, database_kind='sqlite', openai_latency=0.02, completion_tokens=30, workers=4, rate=None,
+                  scenarios=SCENARIOS, storage_format='tables'):
+    '''
+    Run scenarios and return their results.
+
+    :param names: list[str], names of the scenarios in SCENARIOS.
+    :param database_kind: str, 'sqlite', 'memory' or 'postgres'.
+    :param openai_latency: float, seconds every fake completion takes.
+    :param completion_tokens: int, tokens of every fake completion.
+    :param workers: int, number of dispatcher workers.
+    :param rate: float, optional, updates sent per second instead of the rate of the scenario. 0 sends them at once.
+    :param scenarios: dict, scenario name -> settings, SCENARIOS by default. The optional
+        'environment' of a scenario is set while its bot is created.
+    :param storage_format: str, 'tables' or 'snapshot'. The in-memory database only understands 'tables'.
+    :return: dict, scenario name -> results.
+    '''
+    database = create_database(database_kind)
+    fake_openai = FakeOpenAI(openai_latency, completion_tokens)
+    environment = get_environment(workers)
+    environment['STORAGE_BACKEND'] = 'sqlite' if database_kind == 'sqlite' else 'postgres'
+    environment['STORAGE_FORMAT'] = storage_format
+    if database_kind == 'sqlite':
+        environment['SQLITE_PATH'] = database.path
+    results = {}
+    with patch.dict(os.environ, environment), \
+            patch('bot.psycopg2.connect', database.connect), \
+            patch('bot.sqlite3.connect', database.connect), \
+            patch('bot.psycopg2.extras.execute_values', execute_values), \
+            patch('bot.openai.ChatCompletion.create', fake_openai.create), \
+            patch('builtins.print'):
+        for name in names:
+            harness = Harness(scenarios[name], database, fake_openai, rate)
+            try:
+                # The settings of the scenario are read when the bot is created
+                with patch.dict(os.environ, scenarios[name].get('environment', {})):
+                    harness.start()
+                results[name] = harness.run()
+            finally:
+                if harness.bot is not None:
+                    harness.bot.database_manager.close()
+                if database_kind != 'memory':
+                    database.clean_up(harness.get_chat_ids())
+    if database_kind == 'sqlite':
+        database.close()
+    return results
+
+
+def get_backend(database_kind, storage_format):
+    return {'database': database_kind, 'storage_format': storage_format}
+
+
+def compare(results, baseline, tolerance, slack_ms=10):
+    '''
+    :param baseline: dict, scenario name -> results of the baseline.
+    :param tolerance: float, relative change which is not reported.
+    :param slack_ms: float, latency change in milliseconds which is not reported,
+        so that the jitter of short latencies is not taken for a regression.
+    :return: list[str], descriptions of the regressions against the baseline.
+    '''
+    regressions = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        for key in ('p50_ms', 'p95_ms', 'p99_ms', 'db_statements_per_update'):
+            slack = slack_ms if key.endswith('_ms') else 0
+            if result[key] > expected[key] * (1 + tolerance) + slack:
+                regressions.append('{} {}: {} > {}'.format(name, key, result[key], expected[key]))
+        if result['updates_per_second'] < expected['updates_per_second'] * (1 - tolerance):
+            regressions.append('{} updates_per_second: {} < {}'.format(
+                name, result['updates_per_second'], expected['updates_per_second']))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the webhook pipeline with synthetic updates.')
+    parser.add_argument('scenarios', nargs='*', help='names of the scenarios, all by default: {}'.format(
+        ', '.join(SCENARIOS)))
+    parser.add_argument('--database', choices=['sqlite', 'memory', 'postgres'], default='sqlite')
+    parser.add_argument('--storage-format', choices=bot.STORAGE_FORMATS, default='tables')
+    parser.add_argument('--openai-latency', type=float, default=0.02)
+    parser.add_argument('--completion-tokens', type=int, default=30)
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--rate', type=float, default=None)
+    parser.add_argument('--baseline', default=BASELINE_FILE)
+    parser.add_argument('--save-baseline', action='store_true')
+    parser.add_argument('--tolerance', type=float, default=0.25)
+    parser.add_argument('--slack-ms', type=float, default=10)
+    args = parser.parse_args()
+    unknown = set(args.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error('unknown scenarios: {}'.format(', '.join(sorted(unknown))))
+    if args.database == 'memory' and args.storage_format != 'tables':
+        parser.error('the memory database only supports the tables storage format')
+
+    backend = get_backend(args.database, args.storage_format)
+    baseline = None
+    if not args.save_baseline and os.path.exists(args.baseline):
+        with open(args.baseline) as file:
+            baseline = json.load(file)
+        # Checked before the run, so a mismatch does not cost a whole benchmark
+        if baseline.get('backend') != backend:
+            print('The baseline {} was recorded with {}, not {}. Record a baseline for this backend '
+                  'with --save-baseline --baseline <file>'.format(args.baseline, baseline.get('backend'), backend))
+            return 2
+
+    if args.database == 'postgres':
+        bot.load_environment_variables()
+    results = run_scenarios(args.scenarios or list(SCENARIOS), args.database, args.openai_latency,
+                            args.completion_tokens, args.workers, args.rate, storage_format=args.storage_format)
+    for name, result in results.items():
+        print('{:<25} {}'.format(name, ' '.join('{}={}'.format(key, value) for key, value in result.items())))
+
+    if args.save_baseline:
+        with open(args.baseline, 'w') as file:
+            json.dump({'backend': backend, 'scenarios': results}, file, indent=2, sort_keys=True)
+        print('Saved the baseline to {}'.format(args.baseline))
+        return 0
+    if baseline is None:
+        print('No baseline at {}, run with --save-baseline to create one'.format(args.baseline))
+        return 0
+    regressions = compare(results, baseline['scenarios'], args.tolerance, args.slack_ms)
+    for regression in regressions:
+        print('Regression: {}'.format(regression))
+    if not regressions:
+        print('No regressions against {}'.format(args.baseline))
+    return 1 if regressions else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
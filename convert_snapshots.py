@@ -0,0 +1,11 @@
+from bot import create_storage_backend, load_environment_variables
+
+if __name__ == '__main__':
+    # Writes a snapshot with the whole history of every conversation stored in the tables
+    # of the STORAGE_BACKEND. The tables are not changed, so the conversion can be rerun.
+    # Apply the migrations first with `python migrate.py`, then set STORAGE_FORMAT=snapshot.
+    load_environment_variables()
+    storage = create_storage_backend()
+    converted = storage.convert_to_snapshots()
+    print('Converted conversations: {}'.format(converted))
+    storage.close()
@@ -2,6 +2,9 @@
 CREATE TABLE conversations (
     id BIGINT PRIMARY KEY, -- Use BIGINT to store the original Telegram chat ID
     tokens INTEGER NOT NULL DEFAULT 0,
+    message_seq INTEGER NOT NULL DEFAULT 0, -- Number of stored messages, used as the high-water mark for incremental saves
+    summary TEXT, -- Rolling summary of the turns which fell out of the sliding window
+    summarized_seq INTEGER NOT NULL DEFAULT 0, -- Sequence number of the first message not included in the summary
     created_at TIMESTAMP NOT NULL DEFAULT NOW()
 );
 
@@ -10,9 +13,12 @@ CREATE TABLE characters (
     id SERIAL PRIMARY KEY,
     name TEXT NOT NULL,
     conversation_id BIGINT, -- Use BIGINT to reference the original Telegram chat ID
-    FOREIGN KEY (conversation_id) REFERENCES conversations(id)
+    FOREIGN KEY (conversation_id) REFERENCES conversations(id),
+    CONSTRAINT characters_conversation_id_name_key UNIQUE (conversation_id, name)
 );
 
+CREATE INDEX characters_conversation_id_id_idx ON characters (conversation_id, id);
+
 -- Table: messages
 CREATE TABLE messages (
     id SERIAL PRIMARY KEY,
@@ -21,3 +27,26 @@ CREATE TABLE messages (
     content TEXT NOT NULL,
     FOREIGN KEY (conversation_id) REFERENCES conversations(id)
 );
+
+CREATE INDEX messages_conversation_id_id_idx ON messages (conversation_id, id);
+
+-- Table: processed_updates
+CREATE TABLE processed_updates (
+    update_id BIGINT PRIMARY KEY, -- Telegram update ID, used to drop redelivered updates
+    received_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX processed_updates_received_at_idx ON processed_updates (received_at);
+
+-- Table: conversation_snapshots
+CREATE TABLE conversation_snapshots (
+    id BIGINT PRIMARY KEY, -- Telegram chat ID
+    data BYTEA NOT NULL, -- Versioned, zlib-compressed state of the whole conversation, used with STORAGE_FORMAT=snapshot
+    frames INTEGER NOT NULL DEFAULT 1, -- Compressed frames appended since the snapshot was last written whole
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+ALTER TABLE conversation_snapshots ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- Existing databases are upgraded with `python migrate.py`, which applies deployment/migrations.
+-- The migrations are idempotent, so running it against a database created from this file is safe.
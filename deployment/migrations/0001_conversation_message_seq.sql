@@ -0,0 +1,9 @@
+-- High-water mark of the stored messages used by incremental saves
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS message_seq INTEGER NOT NULL DEFAULT 0;
+
+-- Backfill the stored conversations with the number of their messages. System prompts
+-- stored by older versions are not loaded, so they are not counted. Only rows still at 0
+-- are updated, so the migration can be rerun.
+UPDATE conversations c
+SET message_seq = (SELECT COUNT(*) FROM messages m WHERE m.conversation_id = c.id AND m.role <> 'system')
+WHERE c.message_seq = 0;
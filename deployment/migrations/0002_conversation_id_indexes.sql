@@ -0,0 +1,4 @@
+-- migrate:no-transaction
+-- Built concurrently so that the tables stay writable while the indexes are created
+CREATE INDEX CONCURRENTLY IF NOT EXISTS messages_conversation_id_id_idx ON messages (conversation_id, id);
+CREATE INDEX CONCURRENTLY IF NOT EXISTS characters_conversation_id_id_idx ON characters (conversation_id, id);
@@ -0,0 +1,6 @@
+-- Keep the first row of every (conversation_id, name) pair before the unique index is built
+DELETE FROM characters a
+USING characters b
+WHERE a.conversation_id = b.conversation_id
+  AND a.name = b.name
+  AND a.id > b.id;
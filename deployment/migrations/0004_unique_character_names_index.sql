@@ -0,0 +1,3 @@
+-- migrate:no-transaction
+-- If the build fails, the index is left INVALID and has to be dropped before the migration is rerun
+CREATE UNIQUE INDEX CONCURRENTLY IF NOT EXISTS characters_conversation_id_name_key ON characters (conversation_id, name);
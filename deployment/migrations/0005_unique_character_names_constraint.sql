@@ -0,0 +1,9 @@
+-- Attach the unique index built by the previous migration as a constraint
+DO $$
+BEGIN
+    IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'characters_conversation_id_name_key') THEN
+        ALTER TABLE characters
+            ADD CONSTRAINT characters_conversation_id_name_key UNIQUE USING INDEX characters_conversation_id_name_key;
+    END IF;
+END
+$$;
@@ -0,0 +1,7 @@
+-- Telegram update ids which were already accepted, shared by all the bot instances
+CREATE TABLE IF NOT EXISTS processed_updates (
+    update_id BIGINT PRIMARY KEY,
+    received_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+
+CREATE INDEX IF NOT EXISTS processed_updates_received_at_idx ON processed_updates (received_at);
@@ -0,0 +1,3 @@
+-- Rolling summary of the turns which fell out of the sliding window
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summary TEXT;
+ALTER TABLE conversations ADD COLUMN IF NOT EXISTS summarized_seq INTEGER NOT NULL DEFAULT 0;
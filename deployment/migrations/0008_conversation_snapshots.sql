@@ -0,0 +1,8 @@
+-- Compressed snapshots of whole conversations, used with STORAGE_FORMAT=snapshot
+CREATE TABLE IF NOT EXISTS conversation_snapshots (
+    id BIGINT PRIMARY KEY,
+    data BYTEA NOT NULL,
+    updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+);
+-- The snapshots are compressed already, so TOAST only moves them out of line
+ALTER TABLE conversation_snapshots ALTER COLUMN data SET STORAGE EXTERNAL;
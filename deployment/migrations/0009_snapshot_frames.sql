@@ -0,0 +1,2 @@
+-- Number of frames appended to a snapshot since it was last written whole
+ALTER TABLE conversation_snapshots ADD COLUMN IF NOT EXISTS frames INTEGER NOT NULL DEFAULT 1;
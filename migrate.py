@@ -0,0 +1,15 @@
+from bot import DatabaseManager, MigrationRunner, load_environment_variables
+import os
+
+if __name__ == '__main__':
+    load_environment_variables()
+    database_manager = DatabaseManager(
+        os.environ.get('DATABASE_NAME'),
+        os.environ.get('DATABaSE_USER_NAME'),
+        os.environ.get('DATABSAE_PASSWORD'),
+        os.environ.get('DATABASE_HOST'),
+        os.environ.get('DATABASE_PORT')
+    )
+    applied = MigrationRunner(database_manager).run()
+    print('Applied migrations: {}'.format(applied or 'none'))
+    database_manager.close()
@@ -1,10 +1,19 @@
 import unittest
 import bot
-from bot import CharacterRegistry, GPTCharacter, Conversation, DatabaseManager
+from bot import CharacterRegistry, GPTCharacter, Conversation, DatabaseManager, MigrationRunner, UpdateDispatcher, UpdateDeduplicator, TelegramBot, MentionMatcher, ConversationCache, PersistenceQueue, RateLimiter, RateLimitExceeded, TokenBucket, TelegramSender, RetryPolicy, CircuitBreaker, CircuitOpenError, MetricsRegistry, SamplingProfiler, WebhookManager, SQLiteStorage, StorageBackend, ResponsesFailed
 from unittest.mock import MagicMock, patch
 import psycopg2
+import sqlite3
+import telebot
 from dotenv import load_dotenv
 import os
+import sys
+import threading
+import time
+import tempfile
+import json
+import zlib
+import benchmark
 
 def load_test_environment_variables():
     load_dotenv('test.env')
@@ -54,6 +63,34 @@ class TestCharacterRegistry(unittest.TestCase):
         non_existent_character = self.character_registry.get_character("NonExistent")
         self.assertIsNone(non_existent_character)
 
+class TestMentionMatcher(unittest.TestCase):
+    def setUp(self):
+        self.matcher = MentionMatcher({'Биба': ['Бибочка'], 'Jack': ['Jacky'], 'Ванилин': []})
+
+    def test_find(self):
+        self.assertEqual(self.matcher.find('Привет, Биба! How are you, jack?'), ['Биба', 'Jack'])
+        self.assertEqual(self.matcher.find('JACK, ванилин'), ['Jack', 'Ванилин'])
+
+    def test_whole_words_only(self):
+        # Names inside other words are not mentions
+        self.assertEqual(self.matcher.find('Jackson ate a Бибаш'), [])
+
+    def test_aliases(self):
+        self.assertEqual(self.matcher.find('Бибочка и Jacky'), ['Биба', 'Jack'])
+        # A character mentioned several times is returned once
+        self.assertEqual(self.matcher.find('Jack, Jacky, jack'), ['Jack'])
+
+    def test_empty(self):
+        self.assertEqual(MentionMatcher({}).find('Jack'), [])
+        self.assertEqual(self.matcher.find(None), [])
+
+    def test_rebuilt_when_roster_changes(self):
+        character_registry = CharacterRegistry()
+        matcher = character_registry.get_mention_matcher()
+        self.assertIs(character_registry.get_mention_matcher(), matcher)
+        character_registry.load_characters('characters.json')
+        self.assertIsNot(character_registry.get_mention_matcher(), matcher)
+
 class TestConversation(unittest.TestCase):
     def setUp(self):
         # Initialize the CharacterRegistry and the Conversation for testing
@@ -78,28 +115,1225 @@ class TestConversation(unittest.TestCase):
         response = self.conversation.generate_response('Jack')
         self.assertIsInstance(response, str)
 
+    def test_generate_responses(self):
+        # Arrange
+        conversation = Conversation(self.character_registry, [], [])
+        names = list(self.character_registry.characters)
+        for name in names:
+            conversation.add_character(name)
+        conversation.add_user_message('Hello everyone', 'John')
+        history_length = len(conversation.get_messages())
+        def generate_response(message_history, chat_id = None):
+            time.sleep(0.2)
+            # Reply with the name from the reminder, which is the last message
+            name = next(name for name in names if name in message_history[-1]['content'])
+            self.assertEqual(len(message_history), history_length + 2)
+            return 'I am {}'.format(name), 100
+
+        # Act
+        with patch.object(GPTCharacter, 'generate_response', side_effect=generate_response):
+            start = time.monotonic()
+            responses = conversation.generate_responses(names)
+            elapsed = time.monotonic() - start
+
+        # Assert
+        self.assertEqual(responses, ['I am {}'.format(name) for name in names])
+        self.assertLess(elapsed, 0.2 * len(names))
+        self.assertEqual(len(conversation.get_messages()), history_length + len(names))
+        self.assertEqual(conversation.get_messages()[-1]['content'], 'I am {}'.format(names[-1]))
+
+    def test_generate_responses_keeps_successful_replies(self):
+        # Arrange
+        conversation = Conversation(self.character_registry, [], [])
+        names = list(self.character_registry.characters)[:2]
+        for name in names:
+            conversation.add_character(name)
+        conversation.add_user_message('Hello everyone', 'John')
+        history_length = len(conversation.get_messages())
+        def generate_response(message_history, chat_id = None):
+            if names[0] in message_history[-1]['content']:
+                raise RateLimitExceeded('Too many requests')
+            return 'I am {}'.format(names[1]), 100
+
+        # Act
+        with patch.object(GPTCharacter, 'generate_response', side_effect=generate_response):
+            with self.assertRaises(ResponsesFailed) as context:
+                conversation.generate_responses(names)
+
+        # Assert
+        self.assertEqual(context.exception.responses, ['I am {}'.format(names[1])])
+        self.assertEqual([name for name, _ in context.exception.errors], [names[0]])
+        self.assertIsInstance(context.exception.errors[0][1], RateLimitExceeded)
+        self.assertEqual(len(conversation.get_messages()), history_length + 1)
+        self.assertEqual(conversation.token_handler.get_tokens(), 100)
+
+    def test_generate_response_stream(self):
+        # Arrange
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_character('Jack')
+        chunks = [{'choices': [{'delta': {'role': 'assistant'}}]},
+                  {'choices': [{'delta': {'content': 'Hello'}}]},
+                  {'choices': [{'delta': {'content': ' there'}}]},
+                  {'choices': [{'delta': {}}]},
+                  {'choices': [], 'usage': {'total_tokens': 321}}]
+
+        # Act
+        with patch('bot.openai.ChatCompletion.create', return_value=iter(chunks)) as mock_create:
+            texts = list(conversation.generate_response_stream('Jack'))
+
+        # Assert
+        self.assertEqual(texts, ['Hello', 'Hello there'])
+        self.assertTrue(mock_create.call_args.kwargs['stream'])
+        self.assertEqual(mock_create.call_args.kwargs['stream_options'], {'include_usage': True})
+        self.assertEqual(conversation.get_messages()[-1], {'role': 'assistant', 'content': 'Hello there'})
+        self.assertEqual(conversation.token_handler.get_tokens(), 321)
+
+    def test_broken_off_stream_gives_back_tokens(self):
+        # Arrange
+        rate_limiter = RateLimiter(requests_per_minute=60, tokens_per_minute=100000)
+        character = GPTCharacter('Jack', 'A character', rate_limiter=rate_limiter)
+        def chunks():
+            yield {'choices': [{'delta': {'content': 'Hello'}}]}
+            raise ConnectionError('The stream broke off')
+
+        # Act
+        with patch('bot.openai.ChatCompletion.create', return_value=chunks()):
+            with self.assertRaises(ConnectionError):
+                list(character.generate_response_stream([{'role': 'user', 'content': 'Hi'}]))
+
+        # Assert
+        # Only the prompt and the text received are charged, not the whole completion
+        used = 100000 - rate_limiter.get_stats()['tokens_available']
+        self.assertLess(used, bot.COMPLETION_TOKENS)
+        self.assertGreater(used, 0)
+
+    def test_estimate_tokens(self):
+        self.assertEqual(bot.estimate_tokens(''), 0)
+        self.assertEqual(bot.estimate_tokens('abcd'), 1)
+        # Cyrillic letters take two bytes and more tokens than Latin ones
+        self.assertGreater(bot.estimate_tokens('привет'), bot.estimate_tokens('hello!'))
+
+    def test_history_tokens(self):
+        # Test that the token count is kept up to date as messages are added
+        conversation = Conversation(self.character_registry, [{'role': 'user', 'content': 'Hello'}], [])
+        conversation.add_message('user', 'How are you?')
+        expected_tokens = sum(bot.estimate_message_tokens(message) for message in conversation.get_messages())
+        self.assertEqual(conversation.get_history_tokens(), expected_tokens)
+        conversation.replace_messages([])
+        self.assertEqual(conversation.get_history_tokens(), 0)
+
+    def test_assemble_request(self):
+        # Arrange
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_character('Jack')
+        for i in range(500):
+            conversation.add_message('user', 'Message number {} '.format(i) * 10)
+        prompt_builder = self.character_registry.prompt_builder
+
+        # Act
+        request = conversation.assemble_request('Jack')
+
+        # Assert
+        # The newest messages which fit into the budget are sent between the roster and the reminder
+        request_tokens = sum(bot.estimate_message_tokens(message) for message in request)
+        self.assertLessEqual(request_tokens, bot.PROMPT_TOKEN_BUDGET)
+        self.assertEqual(request[0], prompt_builder.build_roster(['Jack']))
+        self.assertEqual(request[-1], prompt_builder.build_reminder('Jack'))
+        self.assertEqual(request[-2], conversation.get_messages()[-1])
+        self.assertLess(len(request), 502)
+
+    def test_generate_response_within_budget(self):
+        # Arrange
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_character('Jack')
+        for i in range(100):
+            conversation.add_message('user', 'Message number {} '.format(i) * 10)
+        output = {'choices': [{'message': {'content': 'Hi'}}], 'usage': {'total_tokens': 100}}
+
+        # Act
+        with patch('bot.openai.ChatCompletion.create', return_value=output) as mock_create:
+            conversation.generate_response('Jack')
+
+        # Assert
+        # The history is reduced based on the local count before the request is sent
+        self.assertEqual(mock_create.call_args.kwargs['max_tokens'], bot.COMPLETION_TOKENS)
+        request = mock_create.call_args.kwargs['messages']
+        self.assertLessEqual(sum(bot.estimate_message_tokens(message) for message in request), bot.PROMPT_TOKEN_BUDGET)
+        self.assertLessEqual(conversation.get_history_tokens(), bot.MAX_HISTORY_TOKENS)
+
     def test_reduce_context_size(self):
         # Test reducing the context size of the conversation
         self.conversation.add_character('Боба')
         self.conversation.add_message('user', 'How are you doing?')
         self.conversation.reduce_context_size('Боба')
-        self.assertEqual(len(self.conversation.messages), 2)
+        # The roster is not kept in the history
+        self.assertEqual(len(self.conversation.messages), 0)
+
+    def test_get_unsaved_messages(self):
+        # Test that only messages past the high-water mark are returned
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_message('user', 'Hello, how are you?')
+        history_version, rewrite, messages, message_seq = conversation.get_unsaved_messages()
+        conversation.mark_saved(history_version, message_seq)
+        conversation.add_message('assistant', 'I am doing well, thank you!')
+
+        history_version, rewrite, messages, message_seq = conversation.get_unsaved_messages()
+        self.assertFalse(rewrite)
+        self.assertEqual(messages, [{'role': 'assistant', 'content': 'I am doing well, thank you!'}])
+        self.assertEqual(message_seq, 2)
+
+    def test_get_unsaved_messages_after_reduce_context_size(self):
+        # Test that replacing the history requests a full rewrite
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_message('user', 'Hello, how are you?')
+        history_version, rewrite, messages, message_seq = conversation.get_unsaved_messages()
+        conversation.mark_saved(history_version, message_seq)
+        conversation.reduce_context_size('Jack')
+
+        history_version, rewrite, messages, message_seq = conversation.get_unsaved_messages()
+        self.assertTrue(rewrite)
+        self.assertEqual(messages, conversation.get_messages())
+        self.assertEqual(message_seq, len(conversation.get_messages()))
+
+        # A replacement during a save keeps the rewrite pending
+        conversation.reduce_context_size('Jack')
+        conversation.mark_saved(history_version, message_seq)
+        self.assertTrue(conversation.get_unsaved_messages()[1])
+
+    def test_get_unsaved_messages_with_offset(self):
+        # Test that a conversation loaded from a tail of the history appends after it
+        conversation = Conversation(self.character_registry, [{'role': 'user', 'content': 'Hello'}], [],
+                                    message_offset=9)
+        conversation.add_message('user', 'Hi')
+
+        history_version, rewrite, messages, message_seq = conversation.get_unsaved_messages()
+        self.assertFalse(rewrite)
+        self.assertEqual(messages, [{'role': 'user', 'content': 'Hi'}])
+        self.assertEqual(message_seq, 11)
+
+    def test_add_character_roster(self):
+        # Test that the roster describes every character under its own name
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_character('Jack')
+        names = [name for name in self.character_registry.characters if name != 'Jack']
+        conversation.add_character(names[0])
+        roster = conversation.assemble_request('Jack')[0]['content']
+        self.assertIn(bot.IMPERSONATED_ROLE_REMINDER_0_EACH_CHARACTER.format(
+            'Jack', self.character_registry.get_character_description('Jack')), roster)
+        self.assertIn(bot.IMPERSONATED_ROLE_REMINDER_0_EACH_CHARACTER.format(
+            names[0], self.character_registry.get_character_description(names[0])), roster)
+
+    def test_prompts_not_stored(self):
+        # Arrange
+        conversation = Conversation(self.character_registry, [], [])
+        conversation.add_character('Jack')
+        conversation.add_user_message('Hello Jack', 'John')
+        output = {'choices': [{'message': {'content': 'Hi'}}], 'usage': {'total_tokens': 100}}
+
+        # Act
+        with patch('bot.openai.ChatCompletion.create', return_value=output) as mock_create:
+            conversation.generate_response('Jack')
+            conversation.add_user_message('How are you?', 'John')
+            conversation.generate_response('Jack')
+
+        # Assert
+        # Only the user messages and the replies are stored
+        self.assertEqual([message['role'] for message in conversation.get_messages()],
+                         ['user', 'assistant', 'user', 'assistant'])
+        # The request has the roster once at the start and the reminder once at the end
+        request = mock_create.call_args.kwargs['messages']
+        self.assertEqual([message['role'] for message in request],
+                         ['system', 'user', 'assistant', 'user', 'system'])
+        self.assertEqual(request[-1], self.character_registry.prompt_builder.build_reminder('Jack'))
+        # The second request would have carried the reminder of the first reply
+        stats = self.character_registry.prompt_builder.get_stats()
+        self.assertEqual(stats['requests'], 2)
+        self.assertEqual(stats['tokens_saved'], bot.estimate_message_tokens({'content': bot.IMPERSONATED_ROLE_REMINDER_1}))
+
+    def test_roster_follows_reloaded_characters(self):
+        # Arrange
+        prompt_builder = self.character_registry.prompt_builder
+        roster = prompt_builder.build_roster(['Jack'])
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'characters.json')
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump({'characters': [{'name': 'Jack', 'description': 'A retired sailor'}]}, file)
+
+        # Act
+        self.character_registry.load_characters(path)
+
+        # Assert
+        self.assertIsNot(prompt_builder.build_roster(['Jack']), roster)
+        self.assertIn('A retired sailor', prompt_builder.build_roster(['Jack'])['content'])
+        self.assertEqual(len(prompt_builder.rosters), 1)
+
+    def test_sliding_window(self):
+        # Arrange
+        summarizer = MagicMock()
+        conversation = Conversation(self.character_registry, [], [], summarizer=summarizer)
+        conversation.add_character('Jack')
+        for i in range(100):
+            conversation.add_message('user', 'Message number {} '.format(i) * 10)
+        history_length = len(conversation.get_messages())
+
+        # Act
+        conversation.limit_context_size('Jack')
+
+        # Assert
+        # The older turns are handed to the summarizer and nothing is dropped yet
+        summarizer.submit.assert_called_once()
+        _, summary, turns, summarized_seq, history_version = summarizer.submit.call_args.args
+        self.assertIsNone(summary)
+        self.assertEqual(turns, conversation.get_messages()[:summarized_seq])
+        self.assertEqual(len(conversation.get_messages()), history_length)
+        window = conversation.get_messages()[summarized_seq:]
+        self.assertLessEqual(sum(bot.estimate_message_tokens(message) for message in window), bot.WINDOW_TOKENS)
+
+        # No second summarization is started while the first one is running
+        conversation.limit_context_size('Jack')
+        summarizer.submit.assert_called_once()
+
+        # Act
+        conversation.apply_summary('They talked', summarized_seq, history_version)
+        request = conversation.assemble_request('Jack')
+
+        # Assert
+        # The summary replaces the summarized turns in the request
+        self.assertEqual(request[1]['content'], bot.SUMMARY.format(summary='They talked'))
+        self.assertEqual(request[2:-1], window)
+
+        # Act
+        history_version, rewrite, messages, message_seq = conversation.get_unsaved_messages()
+        conversation.mark_saved(history_version, message_seq)
+        conversation.limit_context_size('Jack')
+
+        # Assert
+        # The summarized turns are dropped from memory once they are saved
+        self.assertEqual(conversation.get_messages(), window)
+        self.assertEqual(conversation.get_message_seq(), history_length)
+
+    def test_get_messages(self):
+        # Test getting the list of messages in the conversation
+        self.conversation.add_message('user', 'Hello, how are you?')
+        self.conversation.add_message('assistant', 'I am doing well, thank you!')
+        messages = self.conversation.get_messages()
+        self.assertEqual(len(messages), 2)
+
+    def test_sender_name_stored_separately(self):
+        # Test that the sender prefix is only added to the dict view
+        self.conversation.add_user_message('Hello', 'John')
+        self.conversation.add_user_message('Bye', 'John')
+        first, second = self.conversation.messages
+        self.assertEqual(first.content, 'Hello')
+        self.assertIs(first.name, second.name)
+        self.assertEqual(self.conversation.get_messages()[0],
+                         {'role': 'user', 'content': bot.SENDER_PREFIX.format('John', 'Hello')})
+
+    def test_fresh_conversations_do_not_share_state(self):
+        first = Conversation(self.character_registry)
+        second = Conversation(self.character_registry)
+        first.add_message('user', 'Hello')
+        first.characters.append('Jack')
+        self.assertEqual(second.get_messages(), [])
+        self.assertEqual(second.characters, [])
+
+    def test_get_character_names(self):
+        # Test getting the names of all characters in the conversation
+        self.conversation.add_character('Боба')
+        self.conversation.add_character('Зюзя')
+        character_names = self.conversation.get_character_names()
+        self.assertEqual(len(character_names), 2)
+        self.assertIn('Боба', character_names)
+        self.assertIn('Зюзя', character_names)
+
+class TestUpdateDispatcher(unittest.TestCase):
+    def test_chat_order_preserved(self):
+        # Arrange
+        processed = []
+        dispatcher = UpdateDispatcher(lambda update: processed.append(update), workers=4)
+
+        # Act
+        for i in range(50):
+            dispatcher.submit(i % 3, (i % 3, i))
+        dispatcher.start()
+        dispatcher.stop()
+
+        # Assert
+        self.assertEqual(len(processed), 50)
+        for chat_id in range(3):
+            chat_updates = [i for update_chat_id, i in processed if update_chat_id == chat_id]
+            self.assertEqual(chat_updates, sorted(chat_updates))
+
+    def test_chats_processed_in_parallel(self):
+        # Arrange
+        release = threading.Event()
+        started = threading.Event()
+        def handler(update):
+            if update == 'slow':
+                release.wait(5)
+            else:
+                started.set()
+        dispatcher = UpdateDispatcher(handler, workers=2)
+        dispatcher.start()
+
+        # Act
+        dispatcher.submit(1, 'slow')
+        dispatcher.submit(2, 'fast')
+
+        # Assert
+        # The second chat does not wait for the first one
+        self.assertTrue(started.wait(5))
+        release.set()
+        dispatcher.stop()
+
+    def test_drop_newest(self):
+        dispatcher = UpdateDispatcher(lambda update: None, max_queue_size=2)
+        self.assertTrue(dispatcher.submit(1, 'a'))
+        self.assertTrue(dispatcher.submit(1, 'b'))
+        self.assertFalse(dispatcher.submit(1, 'c'))
+        self.assertEqual(list(dispatcher.chat_queues[1]), ['a', 'b'])
+        self.assertEqual(dispatcher.dropped_updates, 1)
+
+    def test_drop_oldest(self):
+        dispatcher = UpdateDispatcher(lambda update: None, max_queue_size=2,
+                                      drop_policy=UpdateDispatcher.DROP_OLDEST)
+        dispatcher.submit(1, 'a')
+        dispatcher.submit(1, 'b')
+        self.assertTrue(dispatcher.submit(1, 'c'))
+        self.assertEqual(list(dispatcher.chat_queues[1]), ['b', 'c'])
+        self.assertEqual(dispatcher.get_queue_size(), 2)
+
+    def test_stop_drains_busy_chat(self):
+        # Arrange
+        processed = []
+        dispatcher = UpdateDispatcher(lambda update: processed.append(update), workers=1)
+        for i in range(20):
+            dispatcher.submit(1, i)
+
+        # Act
+        dispatcher.start()
+        dispatcher.stop(5)
+
+        # Assert
+        self.assertEqual(processed, list(range(20)))
+        with self.assertRaises(bot.DispatcherClosed):
+            dispatcher.submit(1, 20)
+
+    def test_closed_webhook_refuses_updates(self):
+        # Arrange
+        webhook_manager = WebhookManager(MagicMock(), 'https://example.com')
+        webhook_manager.handle_webhook()
+        client = webhook_manager.app.test_client()
+
+        # Act
+        webhook_manager.dispatcher.close()
+        response = client.post('/', json={'update_id': 1})
+
+        # Assert
+        # Telegram redelivers the update, and it is not remembered as a duplicate
+        self.assertEqual(response.status_code, 503)
+        self.assertFalse(webhook_manager.deduplicator.is_duplicate(1))
+
+class TestUpdateDeduplicator(unittest.TestCase):
+    def test_is_duplicate(self):
+        deduplicator = UpdateDeduplicator()
+        self.assertFalse(deduplicator.is_duplicate(1))
+        self.assertTrue(deduplicator.is_duplicate(1))
+        self.assertFalse(deduplicator.is_duplicate(2))
+        self.assertEqual(deduplicator.get_stats(), {'hits': 1, 'misses': 2, 'size': 2})
+
+    def test_max_size(self):
+        deduplicator = UpdateDeduplicator(max_size=2)
+        for update_id in range(3):
+            deduplicator.is_duplicate(update_id)
+        # The oldest update id was forgotten
+        self.assertFalse(deduplicator.is_duplicate(0))
+        self.assertEqual(deduplicator.get_stats()['size'], 2)
+
+    def test_ttl(self):
+        deduplicator = UpdateDeduplicator(ttl=0)
+        deduplicator.is_duplicate(1)
+        self.assertFalse(deduplicator.is_duplicate(1))
+
+    def test_database_mode(self):
+        # Arrange
+        database_manager = MagicMock()
+        database_manager.claim_update.return_value = False
+        deduplicator = UpdateDeduplicator(database_manager=database_manager)
+
+        # Act
+        # Another instance has already received the update
+        is_duplicate = deduplicator.is_duplicate(1)
+
+        # Assert
+        self.assertTrue(is_duplicate)
+        database_manager.claim_update.assert_called_once_with(1)
+        self.assertEqual(deduplicator.get_stats()['hits'], 1)
+
+    def test_database_unavailable(self):
+        database_manager = MagicMock()
+        database_manager.claim_update.side_effect = RuntimeError
+        deduplicator = UpdateDeduplicator(database_manager=database_manager)
+        self.assertFalse(deduplicator.is_duplicate(1))
+        self.assertTrue(deduplicator.is_duplicate(1))
+
+class TestConversationCache(unittest.TestCase):
+    def setUp(self):
+        self.evicted = []
+        self.cache = ConversationCache(lambda chat_id, conversation: self.evicted.append(chat_id),
+                                       max_entries=2)
+
+    def make_conversation(self, size=100):
+        conversation = MagicMock()
+        conversation.estimate_size.return_value = size
+        return conversation
+
+    def test_least_recently_used_is_evicted(self):
+        self.cache.put(1, self.make_conversation())
+        self.cache.put(2, self.make_conversation())
+        self.cache.get(1)
+        self.cache.put(3, self.make_conversation())
+        self.assertEqual(self.evicted, [2])
+        self.assertNotIn(2, self.cache)
+        self.assertIn(1, self.cache)
+
+    def test_max_bytes(self):
+        cache = ConversationCache(lambda chat_id, conversation: self.evicted.append(chat_id),
+                                  max_bytes=250)
+        cache.put(1, self.make_conversation())
+        cache.put(2, self.make_conversation())
+        cache.put(3, self.make_conversation())
+        self.assertEqual(self.evicted, [1])
+        self.assertEqual(cache.get_stats()['bytes'], 200)
+
+    def test_expire(self):
+        self.cache.ttl = 0
+        self.cache.put(1, self.make_conversation())
+        self.assertEqual(self.cache.expire(), 1)
+        self.assertEqual(self.evicted, [1])
+        self.assertEqual(len(self.cache), 0)
+
+    def test_conversation_served_until_written_back(self):
+        # Arrange
+        conversation = self.make_conversation()
+        reloaded = []
+        cache = ConversationCache(lambda chat_id, evicted: reloaded.append(cache.get(chat_id)), ttl=0)
+        cache.put(1, conversation)
+
+        # Act
+        cache.expire()
+
+        # Assert
+        # A request arriving during the write-back gets the cached conversation back
+        self.assertEqual(reloaded, [conversation])
+        self.assertIs(cache.get(1), conversation)
+
+    def test_failed_write_back(self):
+        cache = ConversationCache(MagicMock(side_effect=RuntimeError), ttl=0)
+        cache.put(1, self.make_conversation())
+        cache.expire()
+        self.assertIsNone(cache.get(1))
+
+    def test_stats(self):
+        self.cache.put(1, self.make_conversation())
+        self.cache.get(1)
+        self.cache.get(2)
+        del self.cache[1]
+        self.assertEqual(self.cache.get_stats(),
+                         {'hits': 1, 'misses': 1, 'evictions': 0, 'entries': 0, 'bytes': 0})
+
+class TestPersistenceQueue(unittest.TestCase):
+    def setUp(self):
+        self.database_manager = MagicMock()
+        self.queue = PersistenceQueue(self.database_manager, batch_size=2, flush_interval=60)
+
+    def test_changes_are_coalesced(self):
+        # Arrange
+        conversation = Conversation(CharacterRegistry(), [], [])
+        conversation.on_change = lambda: self.queue.mark_dirty(1, conversation)
+
+        # Act
+        for i in range(3):
+            conversation.add_user_message('Hello, World!', 'John')
+
+        # Assert
+        self.assertEqual(self.queue.get_stats()['depth'], 1)
+        self.assertIs(self.queue.get_pending(1), conversation)
+
+    def test_flush_in_batches(self):
+        for chat_id in range(3):
+            self.queue.mark_dirty(chat_id, MagicMock())
+        self.queue.flush()
+        batches = [call.args[0] for call in self.database_manager.save_conversations.call_args_list]
+        self.assertEqual([[chat_id for chat_id, conversation in batch] for batch in batches], [[0, 1], [2]])
+        self.assertEqual(self.queue.get_stats()['depth'], 0)
+        self.assertEqual(self.queue.get_stats()['flushed'], 3)
+
+    def test_failed_batch_is_requeued(self):
+        self.database_manager.save_conversations.side_effect = RuntimeError
+        self.queue.mark_dirty(1, MagicMock())
+        self.queue._save_batch(requeue=True)
+        self.assertIsNotNone(self.queue.get_pending(1))
+        self.assertEqual(self.queue.get_stats()['failed'], 1)
+
+    def test_size_trigger(self):
+        saved = threading.Event()
+        self.database_manager.save_conversations.side_effect = lambda batch: saved.set()
+        self.queue.start()
+        self.queue.mark_dirty(1, MagicMock())
+        self.queue.mark_dirty(2, MagicMock())
+        # The flush interval is a minute, so only the batch size can trigger the save
+        self.assertTrue(saved.wait(5))
+        self.queue.stop(5)
+
+    def test_stop_drains_queue(self):
+        self.queue.start()
+        self.queue.mark_dirty(1, MagicMock())
+        self.queue.stop(5)
+        self.database_manager.save_conversations.assert_called_once()
+        self.assertEqual(self.queue.get_stats()['depth'], 0)
+
+    def test_flush_while_conversation_changes(self):
+        # Arrange
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = SQLiteStorage(os.path.join(directory.name, 'bot.sqlite3'))
+        self.addCleanup(storage.close)
+        queue = PersistenceQueue(storage, batch_size=1, flush_interval=60)
+        # Every saved turn counts as summarized, so slide_window drops it from memory right away
+        conversation = Conversation(CharacterRegistry(), [], ['Jack'], summarized_seq=10 ** 9, summarizer=MagicMock())
+        conversation.on_change = lambda: queue.mark_dirty(1, conversation)
+        messages = 2000
+        done = threading.Event()
+        # Switch threads as often as possible so that the flushes interleave with the changes
+        switch_interval = sys.getswitchinterval()
+        sys.setswitchinterval(1e-6)
+        self.addCleanup(sys.setswitchinterval, switch_interval)
+
+        def flush():
+            while not done.is_set():
+                queue.flush()
+
+        # Act
+        flusher = threading.Thread(target=flush)
+        flusher.start()
+        for i in range(messages):
+            conversation.add_user_message('Message {}'.format(i), 'John')
+            conversation.slide_window()
+        done.set()
+        flusher.join()
+        queue.flush()
+
+        # Assert
+        state = storage.load_conversation(1)
+        self.assertEqual([message['content'] for message in state['messages']],
+                         [bot.SENDER_PREFIX.format('John', 'Message {}'.format(i)) for i in range(messages)])
+        self.assertEqual(state['message_offset'], 0)
+        self.assertEqual(conversation.get_message_seq(), messages)
+
+    def test_flush_interleaved_with_slide_window(self):
+        # Arrange
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        storage = SQLiteStorage(os.path.join(directory.name, 'bot.sqlite3'))
+        self.addCleanup(storage.close)
+        queue = PersistenceQueue(storage, flush_interval=60)
+        conversation = Conversation(CharacterRegistry(), [], ['Jack'], summarized_seq=10 ** 9, summarizer=MagicMock())
+        conversation.on_change = lambda: queue.mark_dirty(1, conversation)
+        for i in range(3):
+            conversation.add_user_message('Message {}'.format(i), 'John')
+        queue.flush()
+        conversation.add_user_message('Message 3', 'John')
+        copied = threading.Event()
+        slid = threading.Event()
+
+        class PausingList(list):
+            # Holds the flush right after it has copied the history until slide_window has run
+            def pause(self):
+                if threading.current_thread() is not threading.main_thread() and not copied.is_set():
+                    copied.set()
+                    slid.wait(0.5)
+            def __iter__(self):
+                self.pause()
+                return super().__iter__()
+            def __getitem__(self, index):
+                self.pause()
+                return list.__getitem__(self, index)
+        conversation.messages = PausingList(conversation.messages)
+
+        # Act
+        flusher = threading.Thread(target=queue.flush)
+        flusher.start()
+        self.assertTrue(copied.wait(5))
+        conversation.slide_window()
+        slid.set()
+        flusher.join()
+
+        # Assert
+        state = storage.load_conversation(1)
+        self.assertEqual([message['content'] for message in state['messages']],
+                         [bot.SENDER_PREFIX.format('John', 'Message {}'.format(i)) for i in range(4)])
+        self.assertEqual(conversation.get_message_seq(), 4)
+
+class TestRateLimiter(unittest.TestCase):
+    def test_token_bucket(self):
+        bucket = TokenBucket(rate=10, capacity=5)
+        self.assertEqual(bucket.get_wait_time(5), 0)
+        bucket.take(5)
+        self.assertAlmostEqual(bucket.get_wait_time(1), 0.1, places=1)
+        # A request larger than the bucket waits for a full bucket
+        self.assertAlmostEqual(bucket.get_wait_time(50), 0.5, places=1)
+
+    def test_chats_take_turns(self):
+        # Arrange
+        limiter = RateLimiter()
+        limiter.request_bucket = TokenBucket(rate=50, capacity=1)
+        limiter.request_bucket.tokens = 0
+        granted = []
+        threads = []
+        def acquire(chat_id):
+            limiter.acquire(chat_id, 1)
+            granted.append(chat_id)
+
+        # Act
+        # Chat 1 queues three requests before chat 2 queues one
+        for chat_id in [1, 1, 1, 2]:
+            thread = threading.Thread(target=acquire, args=(chat_id,))
+            thread.start()
+            threads.append(thread)
+            while limiter.get_stats()['waiting'] < len(threads):
+                time.sleep(0.001)
+        for thread in threads:
+            thread.join(5)
+
+        # Assert
+        self.assertEqual(granted, [1, 2, 1, 1])
+
+    def test_full_queue_is_rejected(self):
+        limiter = RateLimiter(max_queue_size=0)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(1, 1)
+        self.assertEqual(limiter.get_stats()['rejected'], 1)
+
+    def test_timeout(self):
+        limiter = RateLimiter(requests_per_minute=1, timeout=0.05)
+        limiter.acquire(1, 1)
+        with self.assertRaises(RateLimitExceeded):
+            limiter.acquire(1, 1)
+        self.assertEqual(limiter.get_stats()['waiting'], 0)
+
+    def test_record_usage(self):
+        limiter = RateLimiter(tokens_per_minute=1000)
+        limiter.acquire(1, 600)
+        limiter.record_usage(600, 100)
+        self.assertGreaterEqual(limiter.get_stats()['tokens_available'], 900)
+
+class TestTelegramSender(unittest.TestCase):
+    def setUp(self):
+        self.telegram_api = MagicMock()
+        self.sender = TelegramSender(self.telegram_api)
+
+    def tearDown(self):
+        self.sender.stop(5)
+
+    def test_requests_of_a_chat_are_sent_in_order(self):
+        self.sender.start()
+        futures = [self.sender.send(1, 'send_message', 1, str(i)) for i in range(5)]
+        for future in futures:
+            future.result(5)
+        texts = [call.args[1] for call in self.telegram_api.send_message.call_args_list]
+        self.assertEqual(texts, ['0', '1', '2', '3', '4'])
+
+    def test_group_budget(self):
+        # Arrange
+        sender = TelegramSender(self.telegram_api, group_messages_per_minute=1)
+        sender.start()
+
+        # Act
+        sender.send(-1, 'send_message', -1, 'first').result(5)
+        second = sender.send(-1, 'send_message', -1, 'second')
+        private = sender.send(1, 'send_message', 1, 'private')
+
+        # Assert
+        # The group has used up its budget while the private chat is not held back
+        private.result(5)
+        self.assertFalse(second.done())
+        second.cancel()
+        sender.stop(5)
+
+    def test_retry_after(self):
+        # Arrange
+        error = telebot.apihelper.ApiTelegramException(
+            'sendMessage', None, {'error_code': 429, 'description': 'Too Many Requests',
+                                  'parameters': {'retry_after': 0.05}})
+        self.telegram_api.send_message.side_effect = [error, 'sent']
+        self.sender.start()
+
+        # Act
+        result = self.sender.send(1, 'send_message', 1, 'Hello').result(5)
+
+        # Assert
+        self.assertEqual(result, 'sent')
+        self.assertEqual(self.telegram_api.send_message.call_count, 2)
+        self.assertEqual(self.sender.get_stats(), {'queued': 0, 'throttled': 1})
+
+    def test_cancelled_request_is_not_sent(self):
+        future = self.sender.send(1, 'send_message', 1, 'Hello')
+        future.cancel()
+        self.sender.start()
+        self.sender.stop(5)
+        self.telegram_api.send_message.assert_not_called()
+
+class TestRetryPolicy(unittest.TestCase):
+    def test_retries_transient_errors(self):
+        operation = MagicMock(side_effect=[ValueError, ValueError, 'result'])
+        policy = RetryPolicy((ValueError,), base_delay=0)
+        self.assertEqual(policy.call(operation), 'result')
+        self.assertEqual(operation.call_count, 3)
+
+    def test_gives_up_after_max_attempts(self):
+        operation = MagicMock(side_effect=ValueError)
+        on_retry = MagicMock()
+        policy = RetryPolicy((ValueError,), max_attempts=2, base_delay=0)
+        with self.assertRaises(RuntimeError):
+            policy.call(operation, on_retry=on_retry)
+        self.assertEqual(operation.call_count, 2)
+        on_retry.assert_called_once()
+
+    def test_other_errors_are_not_retried(self):
+        operation = MagicMock(side_effect=KeyError)
+        policy = RetryPolicy((ValueError,), base_delay=0)
+        with self.assertRaises(KeyError):
+            policy.call(operation)
+        operation.assert_called_once()
+
+    def test_open_breaker_fails_fast(self):
+        # Arrange
+        breaker = CircuitBreaker('test', failure_threshold=2, reset_timeout=60)
+        policy = RetryPolicy((ValueError,), max_attempts=1, breaker=breaker)
+        operation = MagicMock(side_effect=ValueError)
+        for i in range(2):
+            with self.assertRaises(RuntimeError):
+                policy.call(operation)
+
+        # Act
+        with self.assertRaises(CircuitOpenError):
+            policy.call(operation)
+
+        # Assert
+        self.assertEqual(operation.call_count, 2)
+        self.assertEqual(breaker.get_state(), CircuitBreaker.OPEN)
+
+    def test_half_open_trial(self):
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        breaker.record_failure()
+        self.assertEqual(breaker.get_state(), CircuitBreaker.HALF_OPEN)
+        # Only one trial call is let through
+        self.assertTrue(breaker.allow_request())
+        self.assertFalse(breaker.allow_request())
+        breaker.record_success()
+        self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+
+    def test_local_errors_leave_breaker_open(self):
+        # Arrange
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        policy = RetryPolicy((ValueError,), max_attempts=1, breaker=breaker, answered_on=(KeyError,))
+        breaker.record_failure()
+
+        # Act
+        # The rate limiter gives up before the dependency is called
+        for error in (RateLimitExceeded, KeyboardInterrupt):
+            with self.assertRaises(error):
+                policy.call(MagicMock(side_effect=error))
+
+        # Assert
+        self.assertEqual(breaker.get_state(), CircuitBreaker.HALF_OPEN)
+        # The trial was released, so the next call may still try
+        self.assertTrue(breaker.allow_request())
+
+    def test_answered_errors_close_breaker(self):
+        # Arrange
+        breaker = CircuitBreaker('test', failure_threshold=1, reset_timeout=0)
+        policy = RetryPolicy((ValueError,), max_attempts=1, breaker=breaker, answered_on=(KeyError,))
+        breaker.record_failure()
+
+        # Act
+        with self.assertRaises(KeyError):
+            policy.call(MagicMock(side_effect=KeyError))
+
+        # Assert
+        self.assertEqual(breaker.get_state(), CircuitBreaker.CLOSED)
+
+    @patch('bot.openai.ChatCompletion.create')
+    def test_openai_errors_are_retried(self, mock_create):
+        output = {'choices': [{'message': {'content': 'Hello'}}], 'usage': {'total_tokens': 10}}
+        mock_create.side_effect = [bot.openai.error.ServiceUnavailableError('Overloaded'), output]
+        character = GPTCharacter('Jack', '', retry_policy=RetryPolicy(bot.OPENAI_TRANSIENT_ERRORS, base_delay=0))
+        self.assertEqual(character.generate_response([]), ('Hello', 10))
+        self.assertEqual(mock_create.call_count, 2)
+
+class TestMetricsRegistry(unittest.TestCase):
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def test_counter_with_labels(self):
+        counter = self.registry.counter('updates_total', 'Updates', ['outcome'])
+        counter.labels('queued').inc()
+        counter.labels('queued').inc(2)
+        self.assertIs(self.registry.counter('updates_total', 'Updates', ['outcome']), counter)
+        self.assertIn('updates_total{outcome="queued"} 3', self.registry.render())
+
+    def test_histogram_buckets(self):
+        histogram = self.registry.histogram('request_seconds', 'Requests', buckets=(0.1, 1))
+        histogram.observe(0.05)
+        histogram.observe(0.5)
+        histogram.observe(5)
+        lines = self.registry.render().splitlines()
+        self.assertIn('# TYPE request_seconds histogram', lines)
+        self.assertIn('request_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('request_seconds_bucket{le="1"} 2', lines)
+        self.assertIn('request_seconds_bucket{le="+Inf"} 3', lines)
+        self.assertIn('request_seconds_count 3', lines)
+
+    def test_function_is_read_on_collection(self):
+        values = [1]
+        self.registry.gauge('queue_depth', 'Depth').set_function(lambda: values[-1])
+        values.append(7)
+        self.assertIn('queue_depth 7', self.registry.render())
+
+    def test_metrics_endpoint(self):
+        # Arrange
+        webhook_manager = WebhookManager(MagicMock(), 'https://example.com')
+        webhook_manager.handle_webhook()
+        client = webhook_manager.app.test_client()
+
+        # Act
+        client.post('/', json={'update_id': 1})
+        response = client.get('/metrics')
+
+        # Assert
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('text/plain', response.headers['Content-Type'])
+        self.assertIn('webhook_request_seconds_count', response.get_data(as_text=True))
+        self.assertIn('updates_total{outcome="queued"}', response.get_data(as_text=True))
+
+class TestSamplingProfiler(unittest.TestCase):
+    def test_sample_rate(self):
+        # Arrange
+        profiler = SamplingProfiler(sample_rate=3)
+
+        # Act
+        selected = [profiler.should_profile(1) for _ in range(9)]
+
+        # Assert
+        self.assertEqual(selected.count(True), 3)
+        self.assertTrue(selected[2])
+
+    def test_chat_id(self):
+        # Arrange
+        profiler = SamplingProfiler(chat_id=5)
+
+        # Act & Assert
+        self.assertTrue(profiler.should_profile(5))
+        self.assertFalse(profiler.should_profile(6))
+        profiler.configure(chat_id=0)
+        self.assertFalse(profiler.should_profile(5))
+
+    def test_profile_records_stacks(self):
+        # Arrange
+        profiler = SamplingProfiler(chat_id=5, interval=0.001)
+
+        def slow_handler():
+            time.sleep(0.05)
+
+        # Act
+        with profiler.profile(5):
+            slow_handler()
+        with profiler.profile(6):
+            time.sleep(0.01)
+
+        # Assert
+        self.assertEqual(profiler.get_stats()['profiled'], 1)
+        self.assertIn('slow_handler', profiler.render())
+        profiler.reset()
+        self.assertEqual(profiler.render(), '')
+
+    def test_profile_endpoint(self):
+        # Arrange
+        telegram_bot = MagicMock()
+        telegram_bot.profiler = SamplingProfiler()
+        webhook_manager = WebhookManager(telegram_bot, 'https://example.com')
+        webhook_manager.handle_webhook()
+        client = webhook_manager.app.test_client()
+
+        # Act & Assert
+        with patch.dict(os.environ, {'ADMIN_TOKEN': 'secret'}):
+            self.assertEqual(client.get('/admin/profile').status_code, 403)
+            response = client.post('/admin/profile', json={'sample_rate': 10, 'chat_id': 7},
+                                   headers={'X-Admin-Token': 'secret'})
+            self.assertEqual(response.status_code, 200)
+            self.assertEqual(response.get_json()['sample_rate'], 10)
+            self.assertEqual(telegram_bot.profiler.chat_id, 7)
+            self.assertEqual(client.get('/admin/profile', headers={'X-Admin-Token': 'secret'}).status_code, 200)
+        with patch.dict(os.environ, {'ADMIN_TOKEN': ''}):
+            self.assertEqual(client.get('/admin/profile').status_code, 404)
+
+    def test_profile_dump_path_is_generated(self):
+        # Arrange
+        telegram_bot = MagicMock()
+        telegram_bot.profiler = SamplingProfiler()
+        webhook_manager = WebhookManager(telegram_bot, 'https://example.com')
+        webhook_manager.handle_webhook()
+        client = webhook_manager.app.test_client()
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        dump_directory = os.path.join(directory.name, 'profiles')
+        outside = os.path.join(directory.name, 'outside.txt')
+        headers = {'X-Admin-Token': 'secret'}
+
+        # Act & Assert
+        with patch.dict(os.environ, {'ADMIN_TOKEN': 'secret', 'PROFILE_DUMP_DIRECTORY': dump_directory}):
+            for path in (outside, '../outside.txt', os.path.join(dump_directory, '..', 'outside.txt')):
+                response = client.post('/admin/profile', json={'dump': path}, headers=headers)
+                self.assertEqual(response.status_code, 400)
+            self.assertFalse(os.path.exists(outside))
+            response = client.post('/admin/profile', json={'dump': True}, headers=headers)
+            self.assertEqual(response.status_code, 200)
+            path = response.get_json()['dump']
+        self.assertEqual(os.path.dirname(path), dump_directory)
+        self.assertTrue(os.path.exists(path))
+
+class TestBenchmark(unittest.TestCase):
+    def test_run_scenarios(self):
+        # Arrange
+        scenarios = {'smoke': {'chats': 3, 'messages_per_chat': 2, 'mentions': 2,
+                               'group': True, 'cold': True, 'rate': 0}}
+
+        # Act
+        results = benchmark.run_scenarios(['smoke'], openai_latency=0, scenarios=scenarios)
+
+        # Assert
+        result = results['smoke']
+        self.assertEqual(result['updates'], 6)
+        self.assertEqual(result['openai_calls'], 12)
+        # Every cold chat is loaded and the replies are saved
+        self.assertGreater(result['db_statements_per_update'], 0)
+        self.assertNotIn('UPDATE_WORKERS', os.environ)
+
+    def test_scenario_environment(self):
+        # Arrange
+        scenarios = {'smoke': {'chats': 1, 'messages_per_chat': 2, 'mentions': 2, 'group': True, 'cold': False,
+                               'rate': 0, 'environment': {'CONCURRENT_REPLIES': '1'}}}
+
+        # Act
+        with patch.object(Conversation, 'generate_responses', autospec=True,
+                          side_effect=Conversation.generate_responses) as generate_responses:
+            results = benchmark.run_scenarios(['smoke'], openai_latency=0, scenarios=scenarios)
+
+        # Assert
+        self.assertEqual(results['smoke']['openai_calls'], 4)
+        self.assertEqual(generate_responses.call_count, 2)
+        self.assertNotIn('CONCURRENT_REPLIES', os.environ)
+
+    def test_refuses_baseline_of_other_backend(self):
+        # Arrange
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, 'baseline.json')
+        with open(path, 'w') as file:
+            json.dump({'backend': benchmark.get_backend('sqlite', 'tables'), 'scenarios': {}}, file)
+        argv = ['benchmark.py', '--storage-format', 'snapshot', '--baseline', path]
+
+        # Act
+        with patch.object(sys, 'argv', argv), patch('benchmark.run_scenarios') as run_scenarios, \
+                patch('builtins.print'):
+            status = benchmark.main()
+
+        # Assert
+        self.assertEqual(status, 2)
+        run_scenarios.assert_not_called()
+
+    def test_compare(self):
+        baseline = {'smoke': {'p50_ms': 10, 'p95_ms': 20, 'p99_ms': 30,
+                              'db_statements_per_update': 4, 'updates_per_second': 100}}
+        result = dict(baseline['smoke'], p95_ms=40, updates_per_second=50)
+        regressions = benchmark.compare({'smoke': result}, baseline, 0.25)
+        self.assertEqual(len(regressions), 2)
+
+class TestTelegramBot(unittest.TestCase):
+    @patch('bot.DatabaseManager')
+    def setUp(self, mock_database_manager):
+        self.bot = TelegramBot()
+        self.bot.telegram_api = MagicMock()
+        self.bot.sender.telegram_api = self.bot.telegram_api
+        self.bot.sender.start()
+
+    def tearDown(self):
+        self.bot.sender.stop(5)
+
+    def make_message(self):
+        message = MagicMock()
+        message.chat.id = 1
+        self.bot.telegram_api.reply_to.return_value.chat.id = 1
+        return message
+
+    def test_reply_streaming(self):
+        # Arrange
+        conversation = MagicMock()
+        conversation.generate_response_stream.return_value = iter(['He', 'Hell', 'Hello'])
+        message = self.make_message()
+        reply = self.bot.telegram_api.reply_to.return_value
+
+        # Act
+        self.bot.stream_edit_interval = 60
+        self.bot.reply_streaming(message, conversation, 'Jack')
+        self.bot.sender.stop(5)
+
+        # Assert
+        # The placeholder is sent first and the edits are throttled to the final text
+        self.bot.telegram_api.reply_to.assert_called_once_with(message, '...')
+        self.bot.telegram_api.edit_message_text.assert_called_once_with('Hello', reply.chat.id, reply.message_id)
+
+    def test_evicted_conversation_is_not_reloaded_while_pending(self):
+        # Arrange
+        conversation = Conversation(CharacterRegistry(), [], [])
+        self.bot.add_conversation(1, conversation)
+        self.bot.conversations.ttl = 0
+        self.bot.conversations.expire()
+
+        # Act
+        conversation.add_user_message('Hello, World!', 'John')
+        initialized = self.bot.is_chat_initialized(1)
+
+        # Assert
+        self.assertIs(initialized, conversation)
+        self.assertIs(self.bot.conversations.get(1), conversation)
+        self.bot.database_manager.load_conversation.assert_not_called()
+
+    def test_conversation_evicted_while_handling_message(self):
+        # Arrange
+        conversation = Conversation(CharacterRegistry(), characters=['Jack'])
+        self.bot.add_conversation(1, conversation)
+        cache_get = self.bot.conversations.get
+        def get_and_evict(chat_id):
+            # The cache drops the entry right after the lookup
+            found = cache_get(chat_id)
+            self.bot.conversations.remove(chat_id)
+            return found
+        message = MagicMock()
+        message.chat.id = 1
+        message.date = time.time()
+        message.text = 'Hello Jack'
+        message.from_user.first_name = 'John'
+        self.bot.reply = MagicMock()
+
+        # Act
+        with patch.object(self.bot.conversations, 'get', side_effect=get_and_evict):
+            self.bot._handle_message_wrapper(message)
+
+        # Assert
+        self.bot.reply.assert_called_once_with(message, conversation, ['Jack'])
+        self.assertEqual(conversation.get_messages()[-1]['role'], 'user')
+
+    def test_no_character_initialized(self):
+        self.assertIs(self.bot.is_any_character_initialized(Conversation(CharacterRegistry())), False)
+
+    def test_prompt_metrics(self):
+        # Arrange
+        self.bot.register_metrics()
+        prompt_builder = self.bot.character_registry.prompt_builder
+        prompt_builder.record_request([{'role': 'assistant', 'content': 'Hi'}], 1)
+
+        # Act
+        metrics = bot.METRICS.render()
+
+        # Assert
+        tokens_saved = prompt_builder.get_stats()['tokens_saved']
+        self.assertIn('prompt_requests_total 1', metrics)
+        self.assertIn('prompt_tokens_saved_total {}'.format(tokens_saved), metrics)
+        self.assertIn('prompt_tokens_saved_per_request', metrics)
+
+    def test_busy_reply(self):
+        # Arrange
+        conversation = Conversation(CharacterRegistry(), characters=['Jack'])
+        self.bot.add_conversation(1, conversation)
+        message = MagicMock()
+        message.chat.id = 1
+        message.date = time.time()
+        message.text = 'Hello Jack'
+        message.from_user.first_name = 'John'
+        self.bot.reply = MagicMock(side_effect=RateLimitExceeded)
+
+        # Act
+        self.bot._handle_message_wrapper(message)
+        self.bot.sender.stop(5)
+
+        # Assert
+        self.bot.telegram_api.reply_to.assert_called_once_with(message, bot.BUSY_REPLY)
+
+    def test_concurrent_reply_sends_successful_responses(self):
+        # Arrange
+        conversation = MagicMock()
+        conversation.generate_responses.side_effect = ResponsesFailed(['I am Bob'], [('Jack', RateLimitExceeded())])
+        message = self.make_message()
+        self.bot.concurrent_replies = True
+
+        # Act
+        with self.assertRaises(RateLimitExceeded):
+            self.bot.reply(message, conversation, ['Jack', 'Bob'])
+        self.bot.sender.stop(5)
+
+        # Assert
+        self.bot.telegram_api.reply_to.assert_called_once_with(message, 'I am Bob')
+
+    def test_reply_streaming_failure(self):
+        # Arrange
+        def stream():
+            yield 'He'
+            yield 'Hello'
+            raise RuntimeError('Failed to execute create_stream after 3 attempts.')
+        conversation = MagicMock()
+        conversation.generate_response_stream.return_value = stream()
+        message = self.make_message()
+        reply = self.bot.telegram_api.reply_to.return_value
+        self.bot.stream_edit_interval = 60
+
+        # Act
+        with self.assertRaises(RuntimeError):
+            self.bot.reply_streaming(message, conversation, 'Jack')
+        self.bot.sender.stop(5)
+
+        # Assert
+        # The partial reply is kept and marked as unfinished
+        self.bot.telegram_api.edit_message_text.assert_called_once_with(
+            'Hello\n\n({})'.format(bot.ERROR_REPLY), reply.chat.id, reply.message_id)
+
+    def test_reply_streaming_failure_before_text(self):
+        # Arrange
+        conversation = MagicMock()
+        conversation.generate_response_stream.side_effect = ConnectionError('Connection reset')
+        message = self.make_message()
+        reply = self.bot.telegram_api.reply_to.return_value
 
-    def test_get_messages(self):
-        # Test getting the list of messages in the conversation
-        self.conversation.add_message('user', 'Hello, how are you?')
-        self.conversation.add_message('assistant', 'I am doing well, thank you!')
-        messages = self.conversation.get_messages()
-        self.assertEqual(len(messages), 2)
+        # Act
+        with self.assertRaises(ConnectionError):
+            self.bot.reply_streaming(message, conversation, 'Jack')
+        self.bot.sender.stop(5)
 
-    def test_get_character_names(self):
-        # Test getting the names of all characters in the conversation
-        self.conversation.add_character('Боба')
-        self.conversation.add_character('Зюзя')
-        character_names = self.conversation.get_character_names()
-        self.assertEqual(len(character_names), 2)
-        self.assertIn('Боба', character_names)
-        self.assertIn('Зюзя', character_names)
+        # Assert
+        self.bot.telegram_api.edit_message_text.assert_called_once_with(
+            bot.ERROR_REPLY, reply.chat.id, reply.message_id)
+
+    def test_reply_streaming_without_throttling(self):
+        conversation = MagicMock()
+        conversation.generate_response_stream.return_value = iter(['He', 'Hell', 'Hello'])
+        self.bot.stream_edit_interval = 0
+        self.bot.reply_streaming(self.make_message(), conversation, 'Jack')
+        self.bot.sender.stop(5)
+        # Edits which were still queued are replaced by the newer ones
+        self.assertLessEqual(self.bot.telegram_api.edit_message_text.call_count, 3)
+        self.assertEqual(self.bot.telegram_api.edit_message_text.call_args.args[0], 'Hello')
 
 class TestDatabaseManagerConnecttion(unittest.TestCase):
     def setUp(self):
@@ -128,6 +1362,543 @@ class TestDatabaseManagerConnecttion(unittest.TestCase):
         with self.assertRaises(RuntimeError):
             db_manager = DatabaseManager(self.dbname, self.user, self.password, self.host, self.port)
 
+class TestDatabaseManagerBulkWrites(unittest.TestCase):
+    @patch('bot.psycopg2.connect')
+    def setUp(self, mock_connect):
+        self.db_manager = DatabaseManager('dbname', 'user', 'password', 'host', 'port')
+        cursor = self.db_manager.connection.cursor.return_value.__enter__.return_value
+        cursor.fetchall.return_value = [('Jack',)]
+
+    @patch('bot.psycopg2.extras.execute_values')
+    def test_save_conversation_single_transaction(self, mock_execute_values):
+        # Arrange
+        conversation = Conversation(CharacterRegistry(), [], [])
+        for i in range(500):
+            conversation.add_user_message('Hello, World!', 'John')
+        conversation.characters.extend(['Jack', 'Jack', 'Bob'])
+
+        # Act
+        self.db_manager.save_conversation(1, conversation)
+
+        # Assert
+        # One multi-row INSERT for the characters and one for the messages
+        self.assertEqual(mock_execute_values.call_count, 2)
+        character_rows = mock_execute_values.call_args_list[0].args[2]
+        self.assertEqual(character_rows, [('Jack', 1), ('Bob', 1)])
+        self.assertIn('ON CONFLICT (conversation_id, name) DO NOTHING', mock_execute_values.call_args_list[0].args[1])
+        message_rows = mock_execute_values.call_args_list[1].args[2]
+        self.assertEqual(len(message_rows), 500)
+        self.db_manager.connection.commit.assert_called_once()
+
+    @patch('bot.psycopg2.extras.execute_values')
+    def test_save_conversations_batch(self, mock_execute_values):
+        conversations = []
+        for conversation_id in range(3):
+            conversation = Conversation(CharacterRegistry(), [], [])
+            conversation.add_user_message('Hello, World!', 'John')
+            conversations.append((conversation_id, conversation))
+        self.db_manager.save_conversations(conversations)
+        # The whole batch is committed at once and every high-water mark moves
+        self.db_manager.connection.commit.assert_called_once()
+        for conversation_id, conversation in conversations:
+            self.assertEqual(conversation.get_unsaved_messages()[2], [])
+
+    @patch('bot.psycopg2.extras.execute_values')
+    def test_insert_messages_empty(self, mock_execute_values):
+        self.db_manager.insert_messages(1, [])
+        mock_execute_values.assert_not_called()
+
+class TestDatabaseManagerLoad(unittest.TestCase):
+    @patch('bot.psycopg2.connect')
+    def setUp(self, mock_connect):
+        self.db_manager = DatabaseManager('dbname', 'user', 'password', 'host', 'port')
+        self.cursor = self.db_manager.connection.cursor.return_value.__enter__.return_value
+
+    # The ordering and the cut-off of the tail by the query itself are checked
+    # against a real database by the StorageBackendConformance tests
+
+    def test_load_conversation_single_query(self):
+        # Arrange
+        # json_agg gives the tail of the ten stored messages oldest first
+        messages = [{'role': 'user', 'content': 'Message 7'},
+                    {'role': 'assistant', 'content': 'Message 8'},
+                    {'role': 'user', 'content': 'Message 9'}]
+        self.cursor.fetchone.return_value = (1000, 10, 'They met', 3, ['Jack', 'Bob'], messages)
+
+        # Act
+        state = self.db_manager.load_conversation(1, token_budget=100)
+
+        # Assert
+        self.assertEqual(state, {'tokens': 1000, 'characters': ['Jack', 'Bob'], 'messages': messages,
+                                 'message_offset': 7, 'summary': 'They met', 'summarized_seq': 3})
+        self.cursor.execute.assert_called_once()
+
+    def test_load_conversation_restores_offset(self):
+        # Arrange
+        messages = [{'role': 'user', 'content': 'Message 7'},
+                    {'role': 'assistant', 'content': 'Message 8'},
+                    {'role': 'user', 'content': 'Message 9'}]
+        self.cursor.fetchone.return_value = (1000, 10, None, 0, ['Jack'], messages)
+
+        # Act
+        conversation = Conversation(CharacterRegistry(), **self.db_manager.load_conversation(1, token_budget=100))
+
+        # Assert
+        # The tail keeps its order and continues the sequence numbers of the stored history
+        self.assertEqual([message['content'] for message in conversation.get_messages()],
+                         ['Message 7', 'Message 8', 'Message 9'])
+        self.assertEqual(conversation.get_message_seq(), 10)
+
+    def test_load_conversation_without_messages(self):
+        # Arrange
+        self.cursor.fetchone.return_value = (0, 0, None, 0, [], [])
+
+        # Act
+        state = self.db_manager.load_conversation(1)
+
+        # Assert
+        self.assertEqual(state['messages'], [])
+        self.assertEqual(state['message_offset'], 0)
+
+    def test_load_conversation_budget_parameters(self):
+        # Arrange
+        self.cursor.fetchone.return_value = (0, 0, None, 0, [], [])
+
+        # Act
+        self.db_manager.load_conversation(1, token_budget=100)
+
+        # Assert
+        # The row limit is the token budget and the length limit is in characters
+        parameters = self.cursor.execute.call_args.args[1]
+        self.assertEqual(parameters, (100, 100 * bot.BYTES_PER_TOKEN, 100 * bot.BYTES_PER_TOKEN, 1))
+
+    def test_load_conversation_non_existent(self):
+        self.cursor.fetchone.return_value = None
+        self.assertIsNone(self.db_manager.load_conversation(123))
+
+class TestDatabaseManagerPool(unittest.TestCase):
+    @patch('bot.psycopg2.pool.ThreadedConnectionPool')
+    def setUp(self, mock_pool):
+        self.db_manager = DatabaseManager('dbname', 'user', 'password', 'host', 'port',
+                                          min_connections=1, max_connections=2)
+        self.pool = self.db_manager.pool
+
+    def test_pooled_mode(self):
+        self.assertIsNone(self.db_manager.connection)
+        self.assertIsNotNone(self.pool)
+
+    def test_operations_check_out_own_connection(self):
+        # Arrange
+        connection = MagicMock(closed=0)
+        self.pool.getconn.return_value = connection
+
+        # Act
+        self.db_manager.insert_message(1, 'user', 'Hello')
+
+        # Assert
+        connection.commit.assert_called_once()
+        self.pool.putconn.assert_called_once_with(connection)
+
+    def test_broken_connection_is_discarded(self):
+        # Arrange
+        broken_connection = MagicMock(closed=1)
+        healthy_connection = MagicMock(closed=0)
+        self.pool.getconn.side_effect = [broken_connection, healthy_connection]
+
+        # Act
+        connection = self.db_manager.checkout_connection()
+        self.db_manager.release_connection(connection)
+
+        # Assert
+        self.assertIs(connection, healthy_connection)
+        self.pool.putconn.assert_any_call(broken_connection, close=True)
+
+    def test_connection_closed_after_operational_error(self):
+        # Arrange
+        connection = MagicMock(closed=0)
+        self.pool.getconn.return_value = connection
+
+        # Act
+        with self.assertRaises(psycopg2.OperationalError):
+            with self.db_manager.transaction() as cursor:
+                raise psycopg2.OperationalError
+
+        # Assert
+        connection.rollback.assert_called_once()
+        self.pool.putconn.assert_called_once_with(connection, close=True)
+
+class StorageBackendConformance:
+    '''
+    Tests every StorageBackend has to pass. Subclasses provide the storage in
+    self.storage and clean up the conversations with the ids in self.conversation_ids.
+    '''
+    conversation_ids = (-101, -102, -103)
+
+    def make_conversation(self, messages=3):
+        conversation = Conversation(CharacterRegistry(), [], [], tokens=42)
+        conversation.characters.extend(['Jack', 'Bob'])
+        for i in range(messages):
+            conversation.add_message('user', 'Message {}'.format(i))
+        return conversation
+
+    def test_load_missing(self):
+        self.assertIsNone(self.storage.load_conversation(-101))
+        self.assertFalse(self.storage.is_conversation_in_database(-101))
+
+    def test_save_and_load(self):
+        # Arrange
+        conversation = self.make_conversation()
+
+        # Act
+        self.storage.save_conversation(-101, conversation)
+        state = self.storage.load_conversation(-101)
+
+        # Assert
+        self.assertTrue(self.storage.is_conversation_in_database(-101))
+        self.assertEqual(state['tokens'], 42)
+        self.assertEqual(state['characters'], ['Jack', 'Bob'])
+        self.assertEqual(state['messages'], conversation.get_messages())
+        self.assertEqual(state['message_offset'], 0)
+
+    def test_save_incremental(self):
+        # Arrange
+        conversation = self.make_conversation()
+        self.storage.save_conversation(-101, conversation)
+
+        # Act
+        conversation.add_message('assistant', 'Reply')
+        conversation.characters.append('Ann')
+        self.storage.save_conversation(-101, conversation)
+        state = self.storage.load_conversation(-101)
+
+        # Assert
+        self.assertEqual(state['messages'], conversation.get_messages())
+        self.assertEqual(state['characters'], ['Jack', 'Bob', 'Ann'])
+
+    def test_save_replaced_history(self):
+        # Arrange
+        conversation = self.make_conversation()
+        self.storage.save_conversation(-101, conversation)
+
+        # Act
+        conversation.replace_messages([{'role': 'user', 'content': 'Fresh start'}])
+        self.storage.save_conversation(-101, conversation)
+
+        # Assert
+        self.assertEqual(self.storage.load_conversation(-101)['messages'],
+                         [{'role': 'user', 'content': 'Fresh start'}])
+
+    def test_append(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation(messages=1))
+
+        # Act
+        self.storage.insert_messages(-101, [{'role': 'assistant', 'content': 'Appended {:02}'.format(i)}
+                                            for i in range(40)])
+
+        # Assert
+        state = self.storage.load_conversation(-101)
+        self.assertEqual(state['messages'][-1], {'role': 'assistant', 'content': 'Appended 39'})
+        self.assertEqual(len(state['messages']), 41)
+        self.assertEqual(state['message_offset'], 0)
+        # Every appended message takes 11 bytes, so the newest two fit into 24 bytes
+        tail = self.storage.load_conversation(-101, token_budget=6)
+        self.assertEqual([message['content'] for message in tail['messages']], ['Appended 38', 'Appended 39'])
+        self.assertEqual(tail['message_offset'], 39)
+        self.assertEqual(Conversation(CharacterRegistry(), **tail).get_message_seq(), 41)
+
+    def test_append_to_missing_conversation(self):
+        with self.assertRaises(ValueError):
+            self.storage.insert_messages(-101, [{'role': 'assistant', 'content': 'Appended'}])
+
+    def test_load_token_budget(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation(messages=10))
+
+        # Act
+        state = self.storage.load_conversation(-101, token_budget=6)
+
+        # Assert
+        # Every message takes 9 bytes, so only the two newest fit into 24 bytes
+        self.assertEqual([message['content'] for message in state['messages']], ['Message 8', 'Message 9'])
+        self.assertEqual(state['message_offset'], 8)
+
+    def test_save_batch(self):
+        # Act
+        self.storage.save_conversations([(conversation_id, self.make_conversation())
+                                         for conversation_id in self.conversation_ids])
+
+        # Assert
+        for conversation_id in self.conversation_ids:
+            self.assertEqual(len(self.storage.load_conversation(conversation_id)['messages']), 3)
+
+    def test_claim_update(self):
+        self.assertTrue(self.storage.claim_update(-101))
+        self.assertFalse(self.storage.claim_update(-101))
+
+    def test_get_character_names(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation())
+
+        # Assert
+        self.assertEqual(self.storage.get_character_names(-101), ['Jack', 'Bob'])
+        self.assertEqual(self.storage.get_character_names(-102), [])
+
+class TestSQLiteStorage(StorageBackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = SQLiteStorage(os.path.join(self.directory.name, 'bot.sqlite3'))
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_wal_mode(self):
+        journal_mode = self.storage.get_connection().execute('PRAGMA journal_mode;').fetchone()[0]
+        self.assertEqual(journal_mode, 'wal')
+
+    def test_rollback(self):
+        with self.assertRaises(ValueError):
+            with self.storage.transaction() as cursor:
+                cursor.execute("INSERT INTO conversations (id) VALUES (-101);")
+                raise ValueError
+        self.assertFalse(self.storage.is_conversation_in_database(-101))
+
+    def test_threads_use_own_connections(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation())
+        results = []
+
+        # Act
+        thread = threading.Thread(target=lambda: results.append(self.storage.load_conversation(-101)))
+        thread.start()
+        thread.join()
+
+        # Assert
+        self.assertEqual(len(results[0]['messages']), 3)
+        self.assertEqual(len(self.storage.connections), 2)
+
+    def test_retry_reopens_connection(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation())
+        self.storage.retry_policy.base_delay = 0
+        broken = self.storage.get_connection()
+        transaction = self.storage.transaction
+        errors = [sqlite3.OperationalError('disk I/O error')]
+
+        def failing_transaction(*args, **kwargs):
+            if errors:
+                raise errors.pop()
+            return transaction(*args, **kwargs)
+
+        # Act
+        with patch.object(self.storage, 'transaction', side_effect=failing_transaction):
+            state = self.storage.load_conversation(-101)
+
+        # Assert
+        self.assertEqual(len(state['messages']), 3)
+        self.assertIsNot(self.storage.get_connection(), broken)
+        self.assertNotIn(broken, self.storage.connections)
+
+    def test_retry_gives_up(self):
+        # Arrange
+        self.storage.retry_policy.base_delay = 0
+        self.storage.retry_policy.max_attempts = 2
+
+        # Act
+        with patch.object(self.storage, 'transaction', side_effect=sqlite3.OperationalError('database is locked')):
+            with self.assertRaises(RuntimeError):
+                self.storage.claim_update(-101)
+
+    def test_interface_is_abstract(self):
+        with self.assertRaises(TypeError):
+            StorageBackend()
+
+class TestSQLiteSnapshotStorage(StorageBackendConformance, unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.storage = SQLiteStorage(os.path.join(self.directory.name, 'bot.sqlite3'), storage_format='snapshot')
+
+    def tearDown(self):
+        self.storage.close()
+        self.directory.cleanup()
+
+    def test_single_row(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation())
+
+        # Act
+        connection = self.storage.get_connection()
+        rows = [connection.execute('SELECT COUNT(*) FROM {};'.format(table)).fetchone()[0]
+                for table in ('conversation_snapshots', 'conversations', 'messages')]
+
+        # Assert
+        self.assertEqual(rows, [1, 0, 0])
+
+    def test_convert_to_snapshots(self):
+        # Arrange
+        self.storage.storage_format = 'tables'
+        conversation = self.make_conversation(messages=10)
+        self.storage.save_conversation(-101, conversation)
+        stored = self.storage.load_conversation(-101, token_budget=6)
+
+        # Act
+        converted = self.storage.convert_to_snapshots()
+        self.storage.storage_format = 'snapshot'
+
+        # Assert
+        self.assertEqual(converted, 1)
+        self.assertEqual(self.storage.load_conversation(-101),
+                         {'tokens': 42, 'characters': ['Jack', 'Bob'], 'messages': conversation.get_messages(),
+                          'message_offset': 0, 'summary': None, 'summarized_seq': 0})
+        self.assertEqual(self.storage.load_conversation(-101, token_budget=6), stored)
+
+    def test_saves_keep_older_history(self):
+        # Arrange
+        self.storage.save_conversation(-101, self.make_conversation(messages=10))
+        conversation = Conversation(CharacterRegistry(), **self.storage.load_conversation(-101, token_budget=6))
+
+        # Act
+        conversation.add_message('assistant', 'Reply')
+        self.storage.save_conversation(-101, conversation)
+        state = self.storage.load_conversation(-101)
+
+        # Assert
+        # Only the two newest messages were loaded, the older ones stay in the snapshot
+        self.assertEqual([message['content'] for message in state['messages']],
+                         ['Message {}'.format(i) for i in range(10)] + ['Reply'])
+        self.assertEqual(self.frames(-101), 2)
+
+    def test_compaction(self):
+        # Arrange
+        conversation = self.make_conversation(messages=1)
+        self.storage.save_conversation(-101, conversation)
+
+        # Act
+        for i in range(bot.SNAPSHOT_MAX_FRAMES):
+            conversation.add_message('user', 'More {}'.format(i))
+            self.storage.save_conversation(-101, conversation)
+
+        # Assert
+        self.assertEqual(self.frames(-101), 2)
+        self.assertEqual(self.storage.load_conversation(-101)['messages'], conversation.get_messages())
+
+    def frames(self, conversation_id):
+        return self.storage.get_connection().execute(
+            'SELECT frames FROM conversation_snapshots WHERE id = ?;', (conversation_id,)).fetchone()[0]
+
+class TestConversationSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.state = {'tokens': 10, 'message_seq': 12, 'summary': 'They met', 'summarized_seq': 2,
+                      'characters': ['Боба', 'Jack'],
+                      'messages': [{'role': 'user', 'content': 'Привет, Боба! Как дела? {}'.format(i)} for i in range(10)]}
+
+    def test_round_trip(self):
+        snapshot = bot.encode_snapshot(self.state)
+        self.assertTrue(snapshot.startswith(bot.SNAPSHOT_MAGIC))
+        self.assertEqual(bot.decode_snapshot(snapshot), dict(self.state, message_offset=2))
+
+    def test_appended_frames(self):
+        # Arrange
+        reply = {'role': 'assistant', 'content': 'Норм'}
+        snapshot = bot.encode_snapshot(self.state)
+
+        # Act
+        snapshot += bot.encode_snapshot_frame({'messages': [reply]})
+        snapshot += bot.encode_snapshot_frame({'tokens': 20, 'characters': ['Jack'], 'messages': []})
+        state = bot.decode_snapshot(snapshot)
+
+        # Assert
+        self.assertEqual(state['messages'], self.state['messages'] + [reply])
+        self.assertEqual((state['message_seq'], state['message_offset']), (13, 2))
+        self.assertEqual((state['tokens'], state['characters']), (20, ['Jack']))
+
+    def test_version_1(self):
+        payload = dict(self.state, messages=[[message['role'], message['content']] for message in self.state['messages']])
+        snapshot = bot.SNAPSHOT_HEADER.pack(bot.SNAPSHOT_MAGIC, 1) + zlib.compress(json.dumps(payload).encode('utf-8'))
+        self.assertEqual(bot.decode_snapshot(snapshot), dict(self.state, message_offset=2))
+
+    def test_smaller_than_messages(self):
+        content_size = sum(len(message['content'].encode('utf-8')) for message in self.state['messages'])
+        self.assertLess(len(bot.encode_snapshot(self.state)), content_size / 2)
+
+    def test_invalid_snapshot(self):
+        snapshot = bot.encode_snapshot(self.state)
+        with self.assertRaises(ValueError):
+            bot.decode_snapshot(b'{}' + snapshot)
+        newer = bot.SNAPSHOT_HEADER.pack(bot.SNAPSHOT_MAGIC, bot.SNAPSHOT_VERSION + 1) + snapshot[bot.SNAPSHOT_HEADER.size:]
+        with self.assertRaises(ValueError):
+            bot.decode_snapshot(newer)
+
+    def test_token_budget(self):
+        # Act
+        state = bot.get_snapshot_conversation(self.state, token_budget=21)
+
+        # Assert
+        # Every message takes 42 bytes, so two fit into 84 bytes
+        self.assertEqual(state['messages'], self.state['messages'][-2:])
+        self.assertEqual(state['message_offset'], 10)
+
+class TestPostgresStorage(StorageBackendConformance, unittest.TestCase):
+    @classmethod
+    def setUpClass(cls):
+        load_test_environment_variables()
+        try:
+            cls.storage = DatabaseManager(os.environ.get('TEST_DATABASE_NAME'), os.environ.get('TEST_DATABaSE_USER_NAME'),
+                                          os.environ.get('TEST_DATABSAE_PASSWORD'), os.environ.get('TEST_DATABASE_HOST'),
+                                          os.environ.get('TEST_DATABASE_PORT'))
+        except RuntimeError:
+            raise unittest.SkipTest('Postgres is not available')
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.storage.close()
+
+    def tearDown(self):
+        with self.storage.transaction() as cursor:
+            for table, column in (('messages', 'conversation_id'), ('characters', 'conversation_id'),
+                                  ('conversations', 'id')):
+                cursor.execute('DELETE FROM {} WHERE {} = ANY(%s);'.format(table, column), (list(self.conversation_ids),))
+            cursor.execute('DELETE FROM processed_updates WHERE update_id = ANY(%s);', (list(self.conversation_ids),))
+            cursor.execute('DELETE FROM conversation_snapshots WHERE id = ANY(%s);', (list(self.conversation_ids),))
+
+class TestPostgresSnapshotStorage(TestPostgresStorage):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.storage.storage_format = 'snapshot'
+
+class TestMigrationRunner(unittest.TestCase):
+    @patch('bot.psycopg2.connect')
+    def setUp(self, mock_connect):
+        self.db_manager = DatabaseManager('dbname', 'user', 'password', 'host', 'port')
+        self.cursor = self.db_manager.connection.cursor.return_value.__enter__.return_value
+        self.runner = MigrationRunner(self.db_manager)
+
+    def test_load_migrations(self):
+        migrations = self.runner.load_migrations()
+        versions = [migration[0] for migration in migrations]
+        self.assertEqual(versions, sorted(set(versions)))
+        # Concurrent index builds cannot run inside a transaction
+        for version, name, sql, in_transaction in migrations:
+            if 'CONCURRENTLY' in sql:
+                self.assertFalse(in_transaction)
+
+    def test_split_statements(self):
+        sql = '-- migrate:no-transaction\n-- comment\nCREATE INDEX a\n    ON t (x);\nCREATE INDEX b ON t (y);\n'
+        self.assertEqual(self.runner.split_statements(sql), ['CREATE INDEX a\n    ON t (x);', 'CREATE INDEX b ON t (y);'])
+
+    def test_run_skips_applied_migrations(self):
+        # Arrange
+        self.cursor.fetchall.return_value = [(version,) for version, *_ in self.runner.load_migrations()[:-1]]
+
+        # Act
+        applied = self.runner.run()
+
+        # Assert
+        self.assertEqual(applied, [self.runner.load_migrations()[-1][0]])
+        self.assertFalse(self.db_manager.connection.autocommit)
+
 class TestDatabaseManager(unittest.TestCase):
     @classmethod
     def setUpClass(cls):
@@ -246,6 +2017,22 @@ class TestDatabaseManager(unittest.TestCase):
         expected_names = ["Alice", "Bob", "Charlie"]  # Expected inserted names
         self.assertEqual(inserted_names, expected_names)
 
+    def test_insert_messages(self):
+        # Arrange
+        conversation_id = 1
+        self.db_manager.cursor.execute(
+            "INSERT INTO conversations (id) VALUES (%s);",
+            (conversation_id, )
+        )
+        messages = [{'role': 'user', 'content': 'Hello {}'.format(i)} for i in range(10)]
+
+        # Act
+        self.db_manager.insert_messages(conversation_id, messages)
+
+        # Assert
+        self.assertEqual(self.db_manager.get_messages(conversation_id),
+                         [('user', 'Hello {}'.format(i)) for i in range(10)])
+
     def test_get_character_names(self):
         # Arrange
         conversation_id = 1
@@ -298,7 +2085,32 @@ class TestDatabaseManager(unittest.TestCase):
         # Check messages table
         cursor.execute("SELECT role, content FROM messages WHERE conversation_id = %s;", (conversation_id,))
         messages = cursor.fetchall()
-        self.assertEqual(len(messages), 7)
+        self.assertEqual(len(messages), 5)
+
+    def test_save_conversation_incremental(self):
+        # Arrange
+        conversation_id = 1
+        conversation = Conversation(CharacterRegistry(), [], [])
+        for i in range(3):
+            conversation.add_user_message('Hello, World!', 'John')
+        self.db_manager.save_conversation(conversation_id, conversation)
+        cursor = self.db_manager.connection.cursor()
+        cursor.execute("SELECT MAX(id) FROM messages WHERE conversation_id = %s;", (conversation_id,))
+        last_id = cursor.fetchone()[0]
+
+        # Act
+        conversation.add_user_message('Bye!', 'John')
+        self.db_manager.save_conversation(conversation_id, conversation)
+
+        # Assert
+        # Previously saved rows are kept and only the new message is appended
+        cursor.execute("SELECT id, content FROM messages WHERE conversation_id = %s ORDER BY id;", (conversation_id,))
+        messages = cursor.fetchall()
+        self.assertEqual(len(messages), 4)
+        self.assertEqual(messages[2][0], last_id)
+        self.assertEqual(messages[3][1], 'The following message is sent by John. Message: Bye!')
+        cursor.execute("SELECT message_seq FROM conversations WHERE id = %s;", (conversation_id,))
+        self.assertEqual(cursor.fetchone()[0], 4)
 
     def test_get_messages(self):
         # Arrange
@@ -380,6 +2192,48 @@ class TestDatabaseManager(unittest.TestCase):
 
         # Assert
         self.assertEqual(actual_output, expected_output)
+    def test_load_conversation(self):
+        # Arrange
+        conversation_id = 1
+        self.db_manager.cursor.execute(
+            "INSERT INTO conversations (id, tokens) VALUES (%s, %s) ",
+            (conversation_id, 1000)
+        )
+        self.db_manager.insert_messages(conversation_id, [{'role': 'user', 'content': 'Hey!'},
+                                                          {'role': 'assistant', 'content': 'Hello!'}])
+        self.db_manager.insert_characters(conversation_id, ['Jack'])
+
+        # Act
+        state = self.db_manager.load_conversation(conversation_id)
+
+        # Assert
+        self.assertEqual(state, {'tokens': 1000,
+                                 'characters': ['Jack'],
+                                 'messages': [{'role': 'user', 'content': 'Hey!'},
+                                              {'role': 'assistant', 'content': 'Hello!'}],
+                                 'message_offset': 0,
+                                 'summary': None,
+                                 'summarized_seq': 0})
+
+    def test_load_conversation_tail(self):
+        # Arrange
+        conversation_id = 1
+        conversation = Conversation(CharacterRegistry(), [], [])
+        for i in range(10):
+            conversation.add_message('user', 'x' * 40)
+        self.db_manager.save_conversation(conversation_id, conversation)
+
+        # Act
+        # Every message takes 10 tokens, so only the last 3 fit
+        state = self.db_manager.load_conversation(conversation_id, token_budget=35)
+
+        # Assert
+        self.assertEqual(len(state['messages']), 3)
+        self.assertEqual(state['message_offset'], 7)
+        cursor = self.db_manager.connection.cursor()
+        cursor.execute("SELECT COUNT(*) FROM messages WHERE conversation_id = %s;", (conversation_id,))
+        self.assertEqual(cursor.fetchone()[0], 10)
+
     def test_read_conversation_non_existent(self):
         # Arrange
         expected_output = None